@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import argparse
 import os
 import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Iterable, Optional
 
@@ -54,6 +56,15 @@ def run_cmd(
     return RunResult(cmd=argv, exit_code=None, timed_out=True, output=out or "")
 
 
+def run_cmds(probes: list[tuple[list[str], dict]], *, jobs: int = 1) -> list[RunResult]:
+  # Runs run_cmd(argv, **kwargs) for each probe on up to `jobs` threads. Results come
+  # back in probe order, not completion order, so the report stays deterministic.
+  if jobs <= 1 or len(probes) <= 1:
+    return [run_cmd(argv, **kwargs) for argv, kwargs in probes]
+  with ThreadPoolExecutor(max_workers=min(jobs, len(probes))) as pool:
+    return list(pool.map(lambda probe: run_cmd(probe[0], **probe[1]), probes))
+
+
 def strip_bun_prefix(output: str) -> str:
   lines = output.splitlines()
   if lines and lines[0].startswith("$ "):
@@ -159,26 +170,31 @@ def parse_options(help_text: str) -> list[OptionSpec]:
   return out
 
 
-def build_original_command_tree(*, max_depth: int = 3) -> list[list[str]]:
+def build_original_command_tree(*, max_depth: int = 3, jobs: int = 1) -> tuple[list[list[str]], dict[str, RunResult]]:
+  # Returns the command paths plus the help output of every probed path (keyed by
+  # cmd_to_str, root as "--help"), so callers don't have to run the same probes again.
   base = ["node", "bundles/ClaudeCodeCode/cli.js"]
-  root_help = run_cmd(base + ["--help"], timeout_s=8.0).output
-  cmds = extract_commands_from_help(root_help)
+  root_help = run_cmd(base + ["--help"], timeout_s=8.0)
+  help_by_cmd: dict[str, RunResult] = {"--help": root_help}
+  cmds = extract_commands_from_help(root_help.output)
   all_paths: list[list[str]] = [[c] for c in cmds]
 
-  # breadth-first, but only a couple levels deep for this CLI
-  idx = 0
-  while idx < len(all_paths):
-    path = all_paths[idx]
-    idx += 1
-    if len(path) >= max_depth:
-      continue
-    help_out = run_cmd(base + path + ["--help"], timeout_s=8.0).output
-    sub = extract_commands_from_help(help_out)
-    for c in sub:
-      sub_path = path + [c]
-      if sub_path not in all_paths:
-        all_paths.append(sub_path)
-  return all_paths
+  # breadth-first, but only a couple levels deep for this CLI; the paths of one level
+  # are probed in parallel and expanded in list order, which gives the same order as
+  # a sequential BFS
+  level = list(all_paths)
+  while level:
+    expand = [path for path in level if len(path) < max_depth]
+    results = run_cmds([(base + path + ["--help"], {"timeout_s": 8.0}) for path in expand], jobs=jobs)
+    level = []
+    for path, rr in zip(expand, results):
+      help_by_cmd[cmd_to_str(path)] = rr
+      for c in extract_commands_from_help(rr.output):
+        sub_path = path + [c]
+        if sub_path not in all_paths:
+          all_paths.append(sub_path)
+          level.append(sub_path)
+  return all_paths, help_by_cmd
 
 
 def cmd_to_str(parts: list[str]) -> str:
@@ -194,44 +210,82 @@ def is_help_like(output: str) -> bool:
   return False
 
 
-def main() -> int:
+def main(argv: Optional[list[str]] = None) -> int:
+  parser = argparse.ArgumentParser(description="Generate investigation/iteration-3-cli-parity.md")
+  parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=min(8, os.cpu_count() or 1),
+    help="probes to run at once (1 = one after another)",
+  )
+  args = parser.parse_args(argv)
+  jobs = max(1, args.jobs)
+
   original_base = ["node", "bundles/ClaudeCodeCode/cli.js"]
   ts_base = ["bun", "run", "cli"]
 
-  original_paths = build_original_command_tree()
+  # Collect help outputs for original commands (for report + option extraction).
+  # The BFS already ran help for every path it expanded; only leaf paths are left.
+  original_paths, original_help_by_cmd = build_original_command_tree(jobs=jobs)
+  ts_help_by_cmd: dict[str, RunResult] = {}
 
   # Ensure alias command paths that don't show as separate list entries
   # (commander prints "install|i" etc, but our regex expands them)
   # Already expanded in extract_commands_from_help.
 
-  # Collect help outputs for original commands (for report + option extraction)
-  original_help_by_cmd: dict[str, RunResult] = {}
-  ts_help_by_cmd: dict[str, RunResult] = {}
+  # Every remaining probe is independent of the others, so the original and TS
+  # probes are queued together and run as one batch.
+  probes: list[tuple[tuple[str, str], list[str], dict]] = []
 
-  # Root tests
-  root_cmds: list[tuple[str, list[str], list[str], dict[str, str]]] = [
-    ("--help", original_base + ["--help"], ts_base + ["--help"], {}),
-    ("--version", original_base + ["--version"], ts_base + ["--version"], {}),
-  ]
+  def probe(slot: tuple[str, str], argv: list[str], **kwargs) -> None:
+    probes.append((slot, argv, kwargs))
 
-  for label, ocmd, tcmd, env in root_cmds:
-    original_help_by_cmd[label] = run_cmd(ocmd, timeout_s=8.0, env=env)
-    ts_help_by_cmd[label] = run_cmd(tcmd, timeout_s=8.0, env=env)
+  # Root tests
+  probe(("original", "--version"), original_base + ["--version"], timeout_s=8.0)
+  probe(("ts", "--help"), ts_base + ["--help"], timeout_s=8.0)
+  probe(("ts", "--version"), ts_base + ["--version"], timeout_s=8.0)
 
   # Per-command help tests
   for path in original_paths:
     key = cmd_to_str(path)
-    original_help_by_cmd[key] = run_cmd(original_base + path + ["--help"], timeout_s=8.0)
+    if key not in original_help_by_cmd:
+      probe(("original", key), original_base + path + ["--help"], timeout_s=8.0)
     # For TS, close stdin immediately so unknown commands don't hang.
-    ts_help_by_cmd[key] = run_cmd(ts_base + path + ["--help"], timeout_s=4.0, stdin_text="")
+    probe(("ts", key), ts_base + path + ["--help"], timeout_s=4.0, stdin_text="")
 
   # Extra TS capabilities for flag extraction
-  ts_mode_help: dict[str, RunResult] = {
-    "root": run_cmd(ts_base + ["--help"], timeout_s=8.0),
-    "doctor": run_cmd(ts_base + ["doctor", "--help"], timeout_s=8.0),
-    "ripgrep": run_cmd(ts_base + ["--ripgrep", "--help"], timeout_s=8.0),
-    "mcp-cli": run_cmd(ts_base + ["--mcp-cli", "--help"], timeout_s=8.0, env={"ENABLE_EXPERIMENTAL_MCP_CLI": "1"}),
-  }
+  probe(("ts-mode", "root"), ts_base + ["--help"], timeout_s=8.0)
+  probe(("ts-mode", "doctor"), ts_base + ["doctor", "--help"], timeout_s=8.0)
+  probe(("ts-mode", "ripgrep"), ts_base + ["--ripgrep", "--help"], timeout_s=8.0)
+  probe(("ts-mode", "mcp-cli"), ts_base + ["--mcp-cli", "--help"], timeout_s=8.0, env={"ENABLE_EXPERIMENTAL_MCP_CLI": "1"})
+
+  # Specific tests requested by the prompt
+  specific_probes: list[tuple[str, list[str], float]] = [
+    ("bun run cli --help", ts_base + ["--help"], 8.0),
+    ("bun run cli --version", ts_base + ["--version"], 8.0),
+    ("bun run cli -p \"test prompt\"", ts_base + ["-p", "test prompt"], 8.0),
+    ("bun run cli --dangerously-skip-permissions -p \"test\"", ts_base + ["--dangerously-skip-permissions", "-p", "test"], 6.0),
+  ]
+  for cmd in ["chat", "run", "config"]:
+    specific_probes.append((f"bun run cli {cmd} --help", ts_base + [cmd, "--help"], 4.0))
+  for label, cmd, timeout_s in specific_probes:
+    probe(("specific", label), cmd, timeout_s=timeout_s)
+
+  # Interactive mode test (best-effort): run with stdin "exit\\n" and a short timeout
+  probe(("interactive", ""), ts_base, timeout_s=5.0, stdin_text="exit\n")
+
+  results = run_cmds([(argv, kwargs) for _, argv, kwargs in probes], jobs=jobs)
+  by_slot = {slot: rr for (slot, _, _), rr in zip(probes, results)}
+
+  for (kind, key), rr in by_slot.items():
+    if kind == "original":
+      original_help_by_cmd[key] = rr
+    elif kind == "ts":
+      ts_help_by_cmd[key] = rr
+  ts_mode_help: dict[str, RunResult] = {key: rr for (kind, key), rr in by_slot.items() if kind == "ts-mode"}
+  specific_tests: list[tuple[str, RunResult]] = [(label, by_slot[("specific", label)]) for label, _, _ in specific_probes]
+  interactive_test = by_slot[("interactive", "")]
 
   original_root_help = original_help_by_cmd["--help"].output
   original_opts: dict[str, OptionSpec] = {}
@@ -255,23 +309,6 @@ def main() -> int:
     ts_all_flags.update(spec.long_flags)
     ts_all_flags.update(spec.short_flags)
 
-  # Specific tests requested by the prompt
-  specific_tests: list[tuple[str, RunResult]] = []
-  specific_tests.append(("bun run cli --help", run_cmd(ts_base + ["--help"], timeout_s=8.0)))
-  specific_tests.append(("bun run cli --version", run_cmd(ts_base + ["--version"], timeout_s=8.0)))
-  specific_tests.append(("bun run cli -p \"test prompt\"", run_cmd(ts_base + ["-p", "test prompt"], timeout_s=8.0)))
-  specific_tests.append(
-    (
-      "bun run cli --dangerously-skip-permissions -p \"test\"",
-      run_cmd(ts_base + ["--dangerously-skip-permissions", "-p", "test"], timeout_s=6.0),
-    )
-  )
-  for cmd in ["chat", "run", "config"]:
-    specific_tests.append((f"bun run cli {cmd} --help", run_cmd(ts_base + [cmd, "--help"], timeout_s=4.0)))
-
-  # Interactive mode test (best-effort): run with stdin "exit\\n" and a short timeout
-  interactive_test = run_cmd(ts_base, timeout_s=5.0, stdin_text="exit\n")
-
   # Write report
   out_lines: list[str] = []
   out_lines.append("# Iteration 3: CLI Command Parity")
@@ -69,7 +69,7 @@ async function indexEmails() {
       const chunks = chunkEmail(email, path);
 
       for (const chunk of chunks) {
-        const embedding = await generateEmbedding(chunk.text);
+        const embedding = await generateEmbedding(chunk.text, "bulk");
 
         // Format embedding as PostgreSQL vector literal
         const vectorLiteral = `[${embedding.join(",")}]`;
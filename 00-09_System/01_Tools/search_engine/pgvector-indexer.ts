@@ -108,7 +108,7 @@ async function main() {
 
         // Generate embeddings for all chunks
         for (const chunk of chunks) {
-          const embedding = await generateEmbedding(chunk.text);
+          const embedding = await generateEmbedding(chunk.text, "bulk");
 
           // Format embedding as PostgreSQL vector literal
           const vectorLiteral = `[${embedding.join(",")}]`;
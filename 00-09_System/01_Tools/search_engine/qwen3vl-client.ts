@@ -31,14 +31,18 @@ export async function checkHealth(): Promise<HealthResponse> {
   return response.json();
 }
 
+export type EmbeddingPriority = "interactive" | "bulk";
+
 /**
  * Generate embedding for a single text
+ * Search queries use the default "interactive" priority (query cache, ahead of indexing);
+ * indexers should pass "bulk"
  */
-export async function generateEmbedding(text: string): Promise<number[]> {
+export async function generateEmbedding(text: string, priority: EmbeddingPriority = "interactive"): Promise<number[]> {
   const response = await fetch(`${EMBED_SERVER_URL}/embedding`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ content: text })
+    body: JSON.stringify({ content: text, priority })
   });
 
   if (!response.ok) {
@@ -67,7 +71,7 @@ export async function generateEmbeddingsBatch(texts: string[]): Promise<number[]
   const response = await fetch(`${EMBED_SERVER_URL}/embedding`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ content: texts })
+    body: JSON.stringify({ content: texts, priority: "bulk" })
   });
 
   if (!response.ok) {
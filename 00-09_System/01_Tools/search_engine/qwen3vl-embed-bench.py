@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Qwen3-VL-Embedding Server Benchmark - offline throughput/latency sweeps
+Boots the FastAPI app from qwen3vl-embed-server.py with a small randomly-initialized
+Qwen3-VL stand-in, so it runs on CPU without downloading the 8B weights
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qwen3vl-embed-server.py")
+
+VOCAB_SIZE = 2000
+
+# Words per text for each length distribution
+LENGTH_DISTRIBUTIONS = {
+    "short": lambda rng: rng.randint(8, 32),
+    "medium": lambda rng: rng.randint(64, 256),
+    "long": lambda rng: rng.randint(512, 2048),
+    "mixed": lambda rng: min(int(rng.lognormvariate(4.0, 1.0)) + 1, 4096),
+}
+
+def load_server(env: dict):
+    """Import the server module by path, with benchmark settings applied to its environment"""
+    os.environ.update(env)
+    spec = importlib.util.spec_from_file_location("qwen3vl_embed_server", SERVER_PATH)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+def build_stand_in(hidden_size: int, layers: int, heads: int, seed: int):
+    """Random Qwen3-VL model and a whitespace word-level tokenizer over w0..wN"""
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen3VLConfig, Qwen3VLForConditionalGeneration
+
+    vocab = {"[PAD]": 0, "[UNK]": 1, "<|endoftext|>": 2}
+    for i in range(VOCAB_SIZE):
+        vocab[f"w{i}"] = len(vocab)
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]", eos_token="<|endoftext|>"
+    )
+
+    head_dim = hidden_size // heads
+    config = Qwen3VLConfig(
+        text_config=dict(
+            vocab_size=len(vocab),
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 3,
+            num_hidden_layers=layers,
+            num_attention_heads=heads,
+            num_key_value_heads=max(heads // 2, 1),
+            head_dim=head_dim,
+            max_position_embeddings=8192,
+            rope_scaling={"rope_type": "default", "mrope_section": [head_dim // 8, head_dim // 8 * 3 // 2, head_dim // 8 * 3 // 2]},
+        ),
+        vision_config=dict(depth=1, hidden_size=32, intermediate_size=64, num_heads=2, out_hidden_size=hidden_size),
+    )
+
+    torch.manual_seed(seed)
+    model = Qwen3VLForConditionalGeneration(config).eval()
+
+    class Processor:
+        pass
+
+    processor = Processor()
+    processor.tokenizer = tokenizer
+    return model, processor
+
+def make_texts(rng: random.Random, distribution: str, count: int) -> List[str]:
+    words = LENGTH_DISTRIBUTIONS[distribution]
+    return [" ".join(f"w{rng.randrange(VOCAB_SIZE)}" for _ in range(words(rng))) for _ in range(count)]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(server, port: int):
+    """Run uvicorn on a background thread and wait until /ready answers"""
+    import uvicorn
+
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=uvicorn_server.run, daemon=True).start()
+
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1) as response:
+                if response.status == 200:
+                    return uvicorn_server
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become ready")
+
+def post_embeddings(port: int, texts: List[str], output_dim: int, lane: str) -> float:
+    """POST one /embeddings request on a priority lane; returns latency in ms"""
+    body = json.dumps({"texts": texts, "normalize": True, "output_dim": output_dim, "priority": lane}).encode()
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/embeddings", data=body, headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=600) as response:
+        response.read()
+    return (time.perf_counter() - start) * 1000
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+@contextlib.contextmanager
+def sample_rss(server, interval: float = 0.01):
+    """Sample this process's RSS on a thread while a scenario runs; yields a dict of start and peak bytes.
+
+    Without a current-RSS reading (macOS without psutil) the lifetime peak is
+    sampled instead, so growth only shows when a scenario sets a new high.
+    """
+    read = server.current_rss_bytes if server.current_rss_bytes() is not None else server.peak_rss_bytes
+    sample = {"start": read()}
+    sample["peak"] = sample["start"]
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            sample["peak"] = max(sample["peak"], read())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield sample
+    finally:
+        stop.set()
+        thread.join()
+        sample["peak"] = max(sample["peak"], read())
+
+def run_scenario(server, port: int, rng: random.Random, batch_size: int, distribution: str,
+                 concurrency: int, output_dim: int, lane: str, requests: int) -> dict:
+    payloads = [make_texts(rng, distribution, batch_size) for _ in range(requests)]
+    post_embeddings(port, make_texts(rng, distribution, batch_size), output_dim, lane)
+
+    with sample_rss(server) as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(lambda texts: post_embeddings(port, texts, output_dim, lane), payloads))
+        wall = time.perf_counter() - start
+
+    texts = batch_size * requests
+    words = sum(len(text.split()) for texts in payloads for text in texts)
+    return {
+        "batch_size": batch_size,
+        "distribution": distribution,
+        "concurrency": concurrency,
+        "output_dim": output_dim,
+        "lane": lane,
+        "requests": requests,
+        "texts": texts,
+        "mean_words_per_text": words / texts,
+        "wall_seconds": wall,
+        "texts_per_second": texts / wall,
+        "requests_per_second": requests / wall,
+        "latency_ms_p50": percentile(latencies, 50),
+        "latency_ms_p99": percentile(latencies, 99),
+        "latency_ms_mean": statistics.fmean(latencies),
+        "rss_start_bytes": rss["start"],
+        "rss_peak_bytes": rss["peak"],
+        "rss_growth_bytes": rss["peak"] - rss["start"],
+    }
+
+def scenario_key(result: dict) -> tuple:
+    # Runs before the lane was recorded used the server's default: interactive for single texts
+    lane = result.get("lane") or ("interactive" if result["batch_size"] == 1 else "bulk")
+    return (result["batch_size"], result["distribution"], result["concurrency"], result["output_dim"], lane)
+
+def compare(results: List[dict], baseline_path: str):
+    """Print throughput and p99 ratios against a previous run's JSON"""
+    with open(baseline_path) as f:
+        baseline = {scenario_key(r): r for r in json.load(f)["results"]}
+
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        previous = baseline.get(scenario_key(result))
+        if previous is None:
+            continue
+        throughput = result["texts_per_second"] / previous["texts_per_second"]
+        p99 = result["latency_ms_p99"] / previous["latency_ms_p99"]
+        growth = ""
+        if "rss_growth_bytes" in previous:
+            growth = f"  rss +{previous['rss_growth_bytes'] / 2**20:.0f} -> +{result['rss_growth_bytes'] / 2**20:.0f}MiB"
+        print(f"  batch={result['batch_size']:<4} {result['distribution']:<7} conc={result['concurrency']:<3} "
+              f"dim={result['output_dim']:<5} {result['lane']:<11} throughput x{throughput:.2f}  p99 x{p99:.2f}{growth}")
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SERVER_PATH), text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark qwen3vl-embed-server.py with a small stand-in model")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1, 8, 32])
+    parser.add_argument("--distributions", default="short,mixed",
+                        help=f"comma-separated, from {', '.join(LENGTH_DISTRIBUTIONS)}")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4])
+    parser.add_argument("--output-dims", type=int_list, default=[256, 64])
+    parser.add_argument("--lanes", default="bulk", help="comma-separated priority lanes: bulk, interactive")
+    parser.add_argument("--requests", type=int, default=20, help="measured requests per scenario")
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    parser.add_argument("--cache", action="store_true", help="keep the embedding and query caches enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="embed-bench.json")
+    parser.add_argument("--compare", metavar="PATH", help="previous results JSON to compare against")
+    args = parser.parse_args()
+
+    distributions = [d.strip() for d in args.distributions.split(",") if d.strip()]
+    for distribution in distributions:
+        if distribution not in LENGTH_DISTRIBUTIONS:
+            parser.error(f"unknown distribution: {distribution}")
+    lanes = [lane.strip() for lane in args.lanes.split(",") if lane.strip()]
+    for lane in lanes:
+        if lane not in ("bulk", "interactive"):
+            parser.error(f"unknown lane: {lane}")
+
+    # Benchmark the pipeline, not the cache or startup warmup
+    server = load_server({
+        "EMBED_CACHE_SIZE": os.environ.get("EMBED_CACHE_SIZE", "10000") if args.cache else "0",
+        "EMBED_QUERY_CACHE_SIZE": os.environ.get("EMBED_QUERY_CACHE_SIZE", "2000") if args.cache else "0",
+        "EMBED_CACHE_DIR": "",
+        "EMBED_WARMUP_LENGTHS": "",
+        "EMBED_WORKERS": "0",
+    })
+
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model, processor = build_stand_in(args.hidden_size, args.layers, args.heads, args.seed)
+    server.truncate_layers(model, server.HIDDEN_LAYER)
+    server._model, server._processor, server._device = model, processor, "cpu"
+    server._batch_limit.set_budget()
+    if server.BACKEND != "eager":
+        server.setup_backend()
+
+    port = free_port()
+    uvicorn_server = start_server(server, port)
+    rng = random.Random(args.seed)
+
+    results = []
+    for batch_size, distribution, concurrency, output_dim, lane in itertools.product(
+        args.batch_sizes, distributions, args.concurrency, args.output_dims, lanes
+    ):
+        result = run_scenario(server, port, rng, batch_size, distribution, concurrency, output_dim, lane, args.requests)
+        results.append(result)
+        print(f"batch={batch_size:<4} {distribution:<7} conc={concurrency:<3} dim={output_dim:<5} {lane:<11} "
+              f"{result['texts_per_second']:8.1f} texts/s  p50 {result['latency_ms_p50']:8.1f}ms  "
+              f"p99 {result['latency_ms_p99']:8.1f}ms  rss +{result['rss_growth_bytes'] / 2**20:.0f}MiB "
+              f"(peak {result['rss_peak_bytes'] / 2**20:.0f}MiB)")
+
+    uvicorn_server.should_exit = True
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_revision": git_revision(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "model": {"hidden_size": args.hidden_size, "layers": args.layers, "heads": args.heads},
+            "settings": {name: getattr(server, name) for name in (
+                "MAX_BATCH_TOKENS", "MAX_BATCH_SIZE", "COALESCE_MAX_BATCH", "COALESCE_MAX_WAIT_MS",
+                "MAX_TEXT_TOKENS", "CPU_PRECISION", "CACHE_MAX_ENTRIES", "QUERY_CACHE_SIZE", "HIDDEN_LAYER", "MEMORY_BUDGET_MB", "BACKEND",
+            )},
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {len(results)} scenarios to {args.out}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
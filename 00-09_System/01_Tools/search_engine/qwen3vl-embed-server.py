@@ -5,11 +5,38 @@ Exposes HTTP API for Bun-based indexer
 """
 
 import torch
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional, Tuple, Union
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import argparse
+import asyncio
+import base64
+import bisect
+import contextlib
+import copy
+import hashlib
+import io
+import math
+import json
+import mmap
+import queue
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import unicodedata
 import uvicorn
 import time
+import os
 
 app = FastAPI(title="Qwen3-VL Embedding Server")
 
@@ -18,15 +45,382 @@ _model = None
 _processor = None
 _device = None
 
+MODEL_NAME = os.environ.get("EMBED_MODEL", "Qwen/Qwen3-VL-Embedding-8B")
+
+# Optional stored projection (e.g. PCA) applied on-device before vectors are copied to host
+PROJECTION_PATH = os.environ.get("EMBED_PROJECTION_PATH", "")
+_projection = None
+_projection_mean = None
+_projection_id = ""
+
+# CPU inference precision: "fp32", "bf16" (bfloat16 weights + autocast) or "int8" (dynamic int8 Linear layers)
+CPU_PRECISION = os.environ.get("EMBED_CPU_PRECISION", "fp32")
+
+# Inference backend for text passes: "eager", "compile" (torch.compile) or "onnx" (ONNX Runtime, CPU provider).
+# Compiled artifacts are cached in EMBED_CHECKPOINT_DIR; below the cosine floor against eager, startup falls back to eager
+BACKEND = os.environ.get("EMBED_BACKEND", "eager")
+BACKEND_MIN_COSINE = float(os.environ.get("EMBED_BACKEND_MIN_COSINE", "0.999"))
+_backend = "eager"
+_text_encoder = None
+_backend_parity = None
+
+# Startup: directory for converted (bf16/int8) CPU checkpoints, and warmup batch shapes ("" disables warmup)
+CHECKPOINT_DIR = os.environ.get("EMBED_CHECKPOINT_DIR", "")
+WARMUP_LENGTHS = [int(n) for n in os.environ.get("EMBED_WARMUP_LENGTHS", "16,128,512").split(",") if n.strip()]
+WARMUP_BATCH = int(os.environ.get("EMBED_WARMUP_BATCH", "4"))
+
+# Readiness, separate from liveness: starting -> loading -> warming -> ready (or failed)
+_state = "starting"
+_load_error = None
+_ready_seconds = None
+
+# Reference set written with --write-parity-reference; checked at startup to report drift against fp32
+PARITY_REFERENCE = os.environ.get("EMBED_PARITY_REFERENCE", "")
+_parity = None
+
+REFERENCE_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "PostgreSQL uses MVCC to handle concurrent transactions.",
+    "Please send the signed contract before the end of the week.",
+    "The hiking trail follows the ridge above the lake.",
+    "Slack messages are chunked by thread before embedding.",
+    "Roast the vegetables at high heat until they caramelize.",
+    "Neural networks learn patterns from data.",
+    "The invoice for October is attached to this email.",
+    "We reached the summit just after sunrise.",
+    "Bun runs TypeScript files without a separate build step.",
+    "Meeting notes: action items are owned by the platform team.",
+    "A much longer passage that rambles on about quarterly planning, hiring, budgets and the "
+    "many small decisions that add up to a roadmap, so that longer sequences are covered too.",
+]
+
+# Layer to embed from, indexed like hidden_states: -1 is the final (normed) output, k > 0 the raw output of
+# decoder layer k (negative counts from the end). Decoder layers past it are dropped when the model loads.
+HIDDEN_LAYER = int(os.environ.get("EMBED_HIDDEN_LAYER", "-1"))
+
+# Micro-batching limits: padded tokens (batch size * longest sequence) and texts per forward pass
+MAX_BATCH_TOKENS = int(os.environ.get("EMBED_MAX_BATCH_TOKENS", "16384"))
+MAX_BATCH_SIZE = int(os.environ.get("EMBED_MAX_BATCH_SIZE", "64"))
+
+# Adaptive micro-batches: activation memory allowed per forward pass (0 = a share of free memory at load time),
+# and the most padded tokens the measured per-token memory may grow a micro-batch to
+MEMORY_BUDGET_MB = float(os.environ.get("EMBED_MEMORY_BUDGET_MB", "0"))
+MAX_ADAPTIVE_BATCH_TOKENS = int(os.environ.get("EMBED_MAX_ADAPTIVE_BATCH_TOKENS", str(MAX_BATCH_TOKENS * 4)))
+
+# Long texts: token budget per text, overlap between windows, windows kept per text, and how windows are pooled
+MAX_TEXT_TOKENS = int(os.environ.get("EMBED_MAX_TEXT_TOKENS", "2048"))
+WINDOW_OVERLAP = int(os.environ.get("EMBED_WINDOW_OVERLAP", "128"))
+MAX_WINDOWS = int(os.environ.get("EMBED_MAX_WINDOWS", "16"))
+WINDOW_POOLING = os.environ.get("EMBED_WINDOW_POOLING", "weighted")  # "mean" or "weighted" (by window length)
+
+# Embedding modes: instruction templates ("{text}" marks the input; "\\n" is a newline). The part before
+# {text} is encoded once and reused as a KV-cache prefix. Requests without a mode embed the raw text.
+QUERY_TEMPLATE = os.environ.get(
+    "EMBED_QUERY_TEMPLATE",
+    "Instruct: Given a search query, retrieve relevant emails, messages, transcripts and documents\\nQuery: {text}"
+).replace("\\n", "\n")
+DOCUMENT_TEMPLATE = os.environ.get("EMBED_DOCUMENT_TEMPLATE", "{text}").replace("\\n", "\n")
+MODE_TEMPLATES = {"query": QUERY_TEMPLATE, "document": DOCUMENT_TEMPLATE}
+POOLING = os.environ.get("EMBED_POOLING", "mean")  # "mean" or "last" (last token, with EOS appended)
+
+# Request coalescing: texts gathered across requests before a shared pass, and how long to wait for them
+COALESCE_MAX_BATCH = int(os.environ.get("EMBED_COALESCE_MAX_BATCH", str(MAX_BATCH_SIZE)))
+COALESCE_MAX_WAIT_MS = float(os.environ.get("EMBED_COALESCE_MAX_WAIT_MS", "5"))
+
+# Admission control: texts allowed to wait for a pass before new requests get 429, and in-process inference threads
+MAX_QUEUED_TEXTS = int(os.environ.get("EMBED_MAX_QUEUED_TEXTS", "2048"))
+INFERENCE_THREADS = int(os.environ.get("EMBED_INFERENCE_THREADS", "1"))
+
+# Worker pool: model-hosting processes, each pinned to its own slice of CPU cores (0 = run in-process)
+WORKERS = int(os.environ.get("EMBED_WORKERS", "0"))
+
+# Embedding cache: in-memory LRU entries, plus an optional on-disk store that survives restarts
+CACHE_MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_SIZE", "10000"))
+CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", "")
+
+# Query cache: search-query vectors with a TTL, sized apart from the document cache, and a log to pre-warm it from
+# The log rotates to EMBED_QUERY_LOG.1 once it reaches EMBED_QUERY_LOG_MAX_BYTES (0 disables rotation)
+QUERY_CACHE_SIZE = int(os.environ.get("EMBED_QUERY_CACHE_SIZE", "2000"))
+QUERY_CACHE_TTL = float(os.environ.get("EMBED_QUERY_CACHE_TTL", "3600"))
+QUERY_LOG = os.environ.get("EMBED_QUERY_LOG", "")
+QUERY_LOG_MAX_BYTES = int(os.environ.get("EMBED_QUERY_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# NDJSON streaming: texts per submitted chunk, and chunks in flight before we stop reading the body
+STREAM_CHUNK_SIZE = int(os.environ.get("EMBED_STREAM_CHUNK_SIZE", "32"))
+STREAM_MAX_INFLIGHT = int(os.environ.get("EMBED_STREAM_MAX_INFLIGHT", "4"))
+
+# Offline bulk embedding (--embed-file): vectors per output shard, and texts per pass
+OFFLINE_SHARD_ROWS = int(os.environ.get("EMBED_OFFLINE_SHARD_ROWS", "100000"))
+OFFLINE_CHUNK_SIZE = int(os.environ.get("EMBED_OFFLINE_CHUNK_SIZE", "256"))
+
+# Vector indexes for /search: a directory of named indexes loaded at startup, stored vector type ("float16" or "int8"),
+# IVF lists (0 = sqrt(rows)), lists probed per query, and the row count below which search is an exact scan
+INDEX_DIR = os.environ.get("EMBED_INDEX_DIR", "")
+INDEX_DTYPE = os.environ.get("EMBED_INDEX_DTYPE", "float16")
+INDEX_NLIST = int(os.environ.get("EMBED_INDEX_NLIST", "0"))
+INDEX_NPROBE = int(os.environ.get("EMBED_INDEX_NPROBE", "16"))
+INDEX_EXACT_MAX_ROWS = int(os.environ.get("EMBED_INDEX_EXACT_MAX_ROWS", "20000"))
+
+# Priority lanes: interactive requests (up to INTERACTIVE_MAX_TEXTS texts) skip the bulk queue
+# and take the model between the micro-batches of a running bulk pass
+LANES = ("interactive", "bulk")
+INTERACTIVE_MAX_TEXTS = int(os.environ.get("EMBED_INTERACTIVE_MAX_TEXTS", "8"))
+
+# Image inputs: longest-side resolution buckets, the vision patch x merge size sides snap to, and preprocessing threads
+# Server-side image paths are only read from under EMBED_IMAGE_ROOT; unset, inputs must be data: URIs or base64
+IMAGE_BUCKETS = sorted(int(n) for n in os.environ.get("EMBED_IMAGE_BUCKETS", "256,512,768,1024").split(",") if n.strip())
+IMAGE_SIZE_FACTOR = int(os.environ.get("EMBED_IMAGE_SIZE_FACTOR", "32"))
+IMAGE_WORKERS = int(os.environ.get("EMBED_IMAGE_WORKERS", "4"))
+IMAGE_ROOT = os.environ.get("EMBED_IMAGE_ROOT", "")
+_image_processor = None
+
+class EmbeddingInput(BaseModel):
+    """One multimodal input: text, an image (path under EMBED_IMAGE_ROOT, data: URI or base64), or a text+image pair"""
+    text: Optional[str] = None
+    image: Optional[str] = None
+
 class EmbeddingRequest(BaseModel):
-    texts: List[str]
+    texts: List[str] = []
+    inputs: Optional[List[EmbeddingInput]] = None
+    priority: Optional[Literal["interactive", "bulk"]] = None
+    mode: Optional[Literal["query", "document"]] = None
     normalize: bool = True
     output_dim: int = 4096
+    quantization: Optional[Literal["int8", "binary"]] = None
+
+class EmbeddingError(BaseModel):
+    index: int
+    error: str
 
 class EmbeddingResponse(BaseModel):
-    embeddings: List[List[float]]
+    # Quantized rows are int8 values or packed sign bytes; keep them integers in JSON
+    embeddings: List[Optional[Union[List[int], List[float]]]]
     dimensions: int
     processing_time_ms: float
+    quantization: Optional[str] = None
+    scales: Optional[List[Optional[float]]] = None
+    windowing: Optional[Dict[str, int]] = None
+    errors: Optional[List[EmbeddingError]] = None
+
+class LlamaEmbeddingRequest(BaseModel):
+    """llama-server /embedding body: one text, or a batch of texts, as content"""
+    content: Union[str, List[str]]
+    normalize: bool = True
+    output_dim: int = 4096
+    priority: Optional[Literal["interactive", "bulk"]] = None
+    mode: Optional[Literal["query", "document"]] = None
+
+class OpenAIEmbeddingRequest(BaseModel):
+    """OpenAI /v1/embeddings body; "dimensions" maps to output_dim"""
+    input: Union[str, List[str]]
+    model: Optional[str] = None
+    encoding_format: Literal["float", "base64"] = "float"
+    dimensions: Optional[int] = None
+    user: Optional[str] = None
+
+class SearchRequest(BaseModel):
+    """/search body: a query to embed and the index to look it up in"""
+    query: str
+    index: str
+    k: int = 10
+    nprobe: Optional[int] = None
+    min_similarity: Optional[float] = None
+    mode: Optional[Literal["query", "document"]] = None
+
+class IndexAddRequest(BaseModel):
+    """Rows for /index/{name}/add: ids with texts to embed, or with embeddings the caller already has"""
+    ids: List[Union[int, str]]
+    texts: Optional[List[str]] = None
+    embeddings: Optional[List[List[float]]] = None
+    mode: Optional[Literal["query", "document"]] = None
+    output_dim: int = 4096
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+TOKEN_BUCKETS = [64, 256, 1024, 4096, 8192, 16384, 32768, 65536, 131072]
+
+class Histogram:
+    """A histogram family; `series` lists the label sets rendered even before their first observation"""
+
+    def __init__(self, name: str, help: str, buckets: List[float], series: List[tuple] = ((),)):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        for labels in series:
+            self._series(labels)
+
+    def _series(self, labels: tuple) -> dict:
+        if labels not in self.series:
+            self.series[labels] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        return self.series[labels]
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self._series(labels)
+        series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            prefix = "".join(f'{k}="{v}",' for k, v in labels)
+            suffix = f"{{{prefix[:-1]}}}" if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], series["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{suffix} {series['sum']}")
+            lines.append(f"{self.name}_count{suffix} {series['count']}")
+        return lines
+
+class Metrics:
+    """Minimal Prometheus-style registry; pool workers log observations for the API process to replay"""
+
+    COUNTERS = {
+        "embed_requests_total": "Requests received, by endpoint",
+        "embed_errors_total": "Errors, by stage",
+        "embed_prefix_fallbacks_total": "Templated texts encoded in full because their tokens split differently at the prefix",
+    }
+
+    def __init__(self):
+        histograms = [
+            Histogram("embed_tokenize_seconds", "Tokenization and padding time per pass", LATENCY_BUCKETS),
+            Histogram("embed_forward_seconds", "Model forward time per micro-batch", LATENCY_BUCKETS),
+            Histogram("embed_pool_seconds", "Pooling, dimension reduction and normalization time per micro-batch", LATENCY_BUCKETS),
+            Histogram("embed_to_host_seconds", "Device-to-host copy time per micro-batch", LATENCY_BUCKETS),
+            Histogram("embed_serialize_seconds", "Response serialization time per request", LATENCY_BUCKETS),
+            Histogram("embed_queue_wait_seconds", "Time a request waits in the batcher before its pass starts, by lane",
+                      LATENCY_BUCKETS, [(("lane", lane),) for lane in LANES]),
+            Histogram("embed_image_preprocess_seconds", "Image read, decode and resize time per image", LATENCY_BUCKETS),
+            Histogram("embed_image_patchify_seconds", "Image processor time per request, all of its images in one call",
+                      LATENCY_BUCKETS),
+            Histogram("embed_search_seconds", "Vector index scan time per /search query", LATENCY_BUCKETS),
+            Histogram("embed_batch_size", "Segments per micro-batch", SIZE_BUCKETS),
+            Histogram("embed_batch_tokens", "Padded tokens per micro-batch", TOKEN_BUCKETS),
+        ]
+        self.histograms = {h.name: h for h in histograms}
+        self.counters = {}
+        self.worker_rss = {}
+        self.log = None
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            self.histograms[name].observe(value, tuple(sorted(labels.items())))
+            if self.log is not None:
+                self.log.append(("observe", name, labels, value))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            if self.log is not None:
+                self.log.append(("inc", name, labels, amount))
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            synchronize()
+            self.observe(name, time.perf_counter() - start)
+
+    def drain(self) -> list:
+        with self._lock:
+            log, self.log = self.log, []
+        return log
+
+    def replay(self, log: list):
+        for kind, name, labels, value in log:
+            if kind == "observe":
+                self.observe(name, value, **labels)
+            else:
+                self.inc(name, value, **labels)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for histogram in self.histograms.values():
+                lines.extend(histogram.render())
+            for name, help in self.COUNTERS.items():
+                lines.extend([f"# HELP {name} {help}", f"# TYPE {name} counter"])
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"{name}{{{label_text}}} {value}")
+
+            lines.extend(["# HELP embed_peak_rss_bytes Peak resident set size, by process", "# TYPE embed_peak_rss_bytes gauge"])
+            lines.append(f'embed_peak_rss_bytes{{process="api"}} {peak_rss_bytes()}')
+            for worker_id, rss in sorted(self.worker_rss.items()):
+                lines.append(f'embed_peak_rss_bytes{{process="worker-{worker_id}"}} {rss}')
+
+        return "\n".join(lines) + "\n"
+
+_metrics = Metrics()
+
+def peak_rss_bytes() -> int:
+    """Peak RSS of this process (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def current_rss_bytes() -> Optional[int]:
+    """Current RSS of this process, from /proc or, elsewhere (macOS), psutil when it is installed"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+def available_memory_bytes() -> Optional[int]:
+    """Free memory for micro-batch budgets: CUDA free, MPS working set left, else host available memory"""
+    if _device == "cuda":
+        return torch.cuda.mem_get_info()[0]
+    if _device == "mps":
+        if not hasattr(torch.mps, "recommended_max_memory"):
+            return None
+        return max(torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory(), 0)
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    # Last resort: physical memory this process hasn't touched
+    try:
+        return max(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") - peak_rss_bytes(), 0)
+    except (ValueError, OSError):
+        return None
+
+def memory_source() -> Optional[str]:
+    """How forward memory is measured on this device: allocator stats, RSS growth, or peak-RSS growth alone"""
+    if _device == "cuda":
+        return "cuda"
+    if _device == "mps":
+        return "mps" if hasattr(torch.mps, "driver_allocated_memory") else None
+    if _device == "cpu":
+        return "rss" if current_rss_bytes() is not None else "max_rss"
+    return None
+
+def synchronize():
+    """Wait for queued device work so stage timings are not just kernel launches"""
+    if _device == "cuda":
+        torch.cuda.synchronize()
+    elif _device == "mps":
+        torch.mps.synchronize()
 
 def load_model():
     """Load model once at startup"""
@@ -40,8 +434,6 @@ def load_model():
 
     from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
 
-    model_name = "Qwen/Qwen3-VL-Embedding-8B"
-
     # Use MPS for Mac, CUDA for GPU, else CPU
     if torch.backends.mps.is_available():
         _device = "mps"
@@ -51,122 +443,2654 @@ def load_model():
         _device = "cpu"
 
     print(f"Using device: {_device}")
+    if _device == "cpu":
+        print(f"CPU precision: {CPU_PRECISION}")
 
     _processor = AutoProcessor.from_pretrained(
-        model_name,
+        MODEL_NAME,
         trust_remote_code=True
     )
 
-    _model = Qwen3VLForConditionalGeneration.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16 if _device != "cpu" else torch.float32,
-        device_map="auto" if _device != "mps" else None,
-        trust_remote_code=True
-    )
+    checkpoint = converted_checkpoint_path()
+    if checkpoint and os.path.exists(checkpoint):
+        print(f"Loading converted checkpoint {checkpoint}")
+        _model = load_converted_checkpoint(checkpoint)
+    else:
+        # safetensors weights are memory-mapped and loaded straight into the target dtype
+        _model = Qwen3VLForConditionalGeneration.from_pretrained(
+            MODEL_NAME,
+            torch_dtype=model_dtype(),
+            device_map="auto" if _device != "mps" else None,
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True
+        )
 
-    if _device == "mps":
-        _model = _model.to(_device)
+        if _device == "mps":
+            _model = _model.to(_device)
+
+        if _device == "cpu" and CPU_PRECISION == "int8":
+            _model = torch.ao.quantization.quantize_dynamic(_model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
 
+        if checkpoint:
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            torch.save(_model.state_dict(), checkpoint + ".tmp")
+            os.replace(checkpoint + ".tmp", checkpoint)
+            print(f"Saved converted checkpoint {checkpoint}")
+
+    truncate_layers(_model, HIDDEN_LAYER)
     _model.eval()
+    _batch_limit.set_budget()
+
+    if PROJECTION_PATH:
+        load_projection(PROJECTION_PATH)
+
+    if BACKEND != "eager":
+        setup_backend()
 
     print(f"Model loaded in {time.time() - start:.1f}s")
 
-def generate_embeddings_sync(texts: List[str], normalize: bool, output_dim: int) -> List[List[float]]:
-    """Generate embeddings for a batch of texts"""
-    global _model, _processor, _device
+    if PARITY_REFERENCE and os.path.exists(PARITY_REFERENCE):
+        check_parity(PARITY_REFERENCE)
+
+def truncate_layers(model, layer: int):
+    """Keep only the decoder layers up to `layer` (and skip the final norm), in place; -1 keeps the whole model"""
+    text_model = model.model.language_model
+    count = len(text_model.layers)
+    keep = layer + count + 1 if layer < 0 else layer
+    if not 0 <= keep <= count:
+        raise ValueError(f"EMBED_HIDDEN_LAYER={layer} is out of range for {count} decoder layers")
+    if layer == -1:
+        return
+
+    text_model.layers = text_model.layers[:keep]
+    text_model.norm = torch.nn.Identity()
+    text_model.config.num_hidden_layers = keep
+    if getattr(text_model.config, "layer_types", None):
+        text_model.config.layer_types = text_model.config.layer_types[:keep]
+    print(f"Embedding from layer {keep} of {count}")
+
+def encoder():
+    """The base transformer: hidden states only, without the LM head's vocabulary logits"""
+    return _model.model
+
+class TextEncoder(torch.nn.Module):
+    """Text-only forward of the base model, (input_ids, attention_mask) -> last hidden state, for compile/onnx"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.language_model = model.model.language_model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        return self.language_model(
+            input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, use_cache=False
+        ).last_hidden_state
+
+class OnnxTextEncoder:
+    """ONNX Runtime session for an exported TextEncoder, called the same way"""
+
+    def __init__(self, path: str):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        (hidden,) = self.session.run(["last_hidden_state"], {
+            "input_ids": input_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+        })
+        return torch.from_numpy(hidden)
+
+def backend_artifact_path(suffix: str) -> str:
+    """Where a compiled backend artifact for this model, precision and layer is cached; empty without a checkpoint dir"""
+    if not CHECKPOINT_DIR:
+        return ""
+    # v2: ONNX exports before it traced the attention mask as the token ids and are never reused
+    name = f"{MODEL_NAME.replace('/', '--')}-{CPU_PRECISION}-layer{HIDDEN_LAYER}-torch{torch.__version__}-v2"
+    return os.path.join(CHECKPOINT_DIR, f"{name}-{suffix}")
+
+def export_onnx(path: str):
+    """Export TextEncoder with dynamic batch and sequence axes into directory `path` (model.onnx + weights)"""
+    tmp = path + ".tmp"
+    os.makedirs(tmp, exist_ok=True)
+    input_ids = torch.randint(0, _processor.tokenizer.vocab_size, (2, 16), device=_device)
+    attention_mask = torch.ones(2, 16, dtype=torch.long, device=_device)
+    axes = {0: torch.export.Dim.DYNAMIC, 1: torch.export.Dim.DYNAMIC}
+    with torch.no_grad():
+        torch.onnx.export(
+            TextEncoder(_model).eval(), (input_ids, attention_mask), os.path.join(tmp, "model.onnx"),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_shapes=(axes, axes),
+            external_data=True
+        )
+    os.replace(tmp, path)
+
+def setup_backend():
+    """Build the EMBED_BACKEND text encoder (loading cached artifacts), then check it against eager"""
+    global _backend, _text_encoder
+
+    start = time.time()
+    try:
+        if BACKEND == "compile":
+            cache = backend_artifact_path("inductor.bin")
+            if cache and os.path.exists(cache):
+                with open(cache, "rb") as f:
+                    torch.compiler.load_cache_artifacts(f.read())
+            _text_encoder = torch.compile(TextEncoder(_model).eval(), dynamic=True)
+        elif BACKEND == "onnx":
+            if _device != "cpu":
+                raise RuntimeError("the onnx backend runs on the CPU provider only")
+            path = backend_artifact_path("onnx") or os.path.join(tempfile.mkdtemp(prefix="embed-onnx-"), "model")
+            if not os.path.exists(path):
+                print(f"Exporting ONNX text encoder to {path}")
+                export_onnx(path)
+            _text_encoder = OnnxTextEncoder(os.path.join(path, "model.onnx"))
+        else:
+            raise ValueError(f"unknown backend {BACKEND!r}")
+
+        _backend = BACKEND
+        check_backend_parity()
+    except Exception as e:
+        print(f"Backend {BACKEND} unavailable, using eager: {str(e)[:200]}")
+        _backend, _text_encoder = "eager", None
+        return
+
+    if _backend == "compile":
+        cache = backend_artifact_path("inductor.bin")
+        artifacts = torch.compiler.save_cache_artifacts()
+        if cache and artifacts:
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            with open(cache + ".tmp", "wb") as f:
+                f.write(artifacts[0])
+            os.replace(cache + ".tmp", cache)
+    print(f"Backend {_backend} ready in {time.time() - start:.1f}s")
+
+def vocabulary_texts(count: int = 8, seed: int = 0) -> List[str]:
+    """Texts decoded from random non-special token ids, of growing length, for backend parity checks"""
+    tokenizer = _processor.tokenizer
+    special = set(tokenizer.all_special_ids)
+    rng = np.random.default_rng(seed)
+    texts = []
+    for n in range(count):
+        ids = [i for i in rng.integers(0, tokenizer.vocab_size, 8 + 24 * n).tolist() if i not in special]
+        texts.append(tokenizer.decode(ids))
+    return texts
+
+def backend_cosines(texts: List[str]) -> np.ndarray:
+    """Cosine between the active backend's and eager's embedding of each text"""
+    global _text_encoder
+
+    text_encoder, _text_encoder = _text_encoder, None
+    try:
+        eager, _, _ = generate_embeddings_sync(texts, True, 0)
+    finally:
+        _text_encoder = text_encoder
+    embeddings, _, errors = generate_embeddings_sync(texts, True, 0)
+    if errors:
+        raise RuntimeError(f"parity texts failed: {errors}")
+    return (embeddings * eager).sum(axis=1)
+
+def check_backend_parity():
+    """Embed REFERENCE_TEXTS and vocabulary texts with the backend and with eager; fall back to eager below BACKEND_MIN_COSINE"""
+    global _backend_parity
+
+    cosines = backend_cosines(REFERENCE_TEXTS + vocabulary_texts())
+    _backend_parity = {
+        "backend": BACKEND,
+        "texts": len(cosines),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+    }
+    print(f"Backend {BACKEND} vs eager: mean cosine {cosines.mean():.6f}, min {cosines.min():.6f}")
+    if cosines.min() < BACKEND_MIN_COSINE:
+        raise RuntimeError(f"min cosine {cosines.min():.6f} is below EMBED_BACKEND_MIN_COSINE={BACKEND_MIN_COSINE}")
+
+def converted_checkpoint_path() -> str:
+    """Where the converted CPU model is cached; empty when there is nothing to convert"""
+    if not CHECKPOINT_DIR or _device != "cpu" or CPU_PRECISION == "fp32":
+        return ""
+    return os.path.join(CHECKPOINT_DIR, f"{MODEL_NAME.replace('/', '--')}-{CPU_PRECISION}.pt")
+
+def load_converted_checkpoint(path: str):
+    """Rebuild the model from a converted state dict on empty weights, without redoing the conversion"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, Qwen3VLForConditionalGeneration
+
+    config = AutoConfig.from_pretrained(MODEL_NAME, trust_remote_code=True)
+    with init_empty_weights():
+        model = Qwen3VLForConditionalGeneration._from_config(config, torch_dtype=model_dtype())
+
+    if CPU_PRECISION == "int8":
+        for module in list(model.modules()):
+            for name, child in list(module.named_children()):
+                if type(child) is torch.nn.Linear:
+                    setattr(module, name, torch.ao.nn.quantized.dynamic.Linear(
+                        child.in_features, child.out_features, bias_=child.bias is not None, dtype=torch.qint8
+                    ))
+
+    model.load_state_dict(torch.load(path, mmap=True, weights_only=True), assign=True)
+    return model
+
+def warm_up():
+    """Run a warmup batch at each configured sequence length so the first requests skip one-time costs"""
+    for length in WARMUP_LENGTHS:
+        start = time.time()
+        generate_embeddings_sync([" ".join(["warmup"] * length)] * WARMUP_BATCH, True, 0)
+        print(f"Warmup {WARMUP_BATCH} x ~{length} tokens: {(time.time() - start) * 1000:.0f}ms")
+
+def start_model():
+    """Startup pipeline, run off the event loop so /health answers while it progresses"""
+    global _state, _load_error, _ready_seconds
+
+    start = time.time()
+    try:
+        _state = "loading"
+        load_model()
+        _state = "warming"
+        warm_up()
+        _state = "ready"
+        _ready_seconds = time.time() - start
+        print(f"Ready in {_ready_seconds:.1f}s")
+    except Exception as e:
+        _state = "failed"
+        _load_error = str(e)[:200]
+        print(f"Startup failed: {_load_error}")
+
+def model_dtype() -> torch.dtype:
+    """Weight dtype: float16 on accelerators, float32 or bfloat16 on CPU"""
+    if _device != "cpu":
+        return torch.float16
+    return torch.bfloat16 if CPU_PRECISION == "bf16" else torch.float32
+
+def inference_context():
+    """Autocast to bfloat16 for the bf16 CPU mode, so stray float32 ops run in bf16 too"""
+    if _device == "cpu" and CPU_PRECISION == "bf16":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+class ForwardGate:
+    """Lets interactive passes take the model between the micro-batches of running bulk passes"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._bulk_running = 0
+        self._interactive_running = False
+        self._interactive_waiting = 0
+
+    @contextlib.contextmanager
+    def hold(self, interactive: bool):
+        with self._cond:
+            if interactive:
+                self._interactive_waiting += 1
+                while self._bulk_running or self._interactive_running:
+                    self._cond.wait()
+                self._interactive_waiting -= 1
+                self._interactive_running = True
+            else:
+                while self._interactive_waiting or self._interactive_running:
+                    self._cond.wait()
+                self._bulk_running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                if interactive:
+                    self._interactive_running = False
+                else:
+                    self._bulk_running -= 1
+                self._cond.notify_all()
+
+_forward_gate = ForwardGate()
+
+class BatchMemoryLimit:
+    """Padded-token limit for micro-batches: budget / measured bytes per token, capped after OOMs"""
 
-    embeddings = []
+    def __init__(self, initial_tokens: int, max_tokens: int):
+        self.max_tokens = initial_tokens
+        self.ceiling = max_tokens
+        self.budget = 0
+        self.bytes_per_token = 0.0
+        self.failures = 0
+        self._failure_cap = max_tokens
+        self.source = None
+        self._peak = 0
+        self._lock = threading.Lock()
+
+    def set_budget(self):
+        """Take EMBED_MEMORY_BUDGET_MB, or half the memory left after loading, shared between pool workers"""
+        if MEMORY_BUDGET_MB > 0:
+            self.budget = int(MEMORY_BUDGET_MB * 2**20)
+        else:
+            available = available_memory_bytes()
+            self.budget = available // (2 * max(WORKERS, 1)) if available else 0
+        self.source = memory_source()
+        self._peak = self._high_water()
+
+    def _high_water(self) -> int:
+        """The level a new peak is measured against: the MPS driver's allocation, or peak RSS"""
+        if self.source == "mps":
+            return torch.mps.driver_allocated_memory()
+        return peak_rss_bytes()
+
+    @contextlib.contextmanager
+    def measure(self, tokens: int):
+        """Wrap a forward over `tokens` padded tokens; a failure lowers the limit, a new peak refines it"""
+        if self.source == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            before = torch.cuda.memory_allocated()
+        elif self.source == "rss":
+            before = current_rss_bytes()
+        elif self.source in ("mps", "max_rss"):
+            before = self._high_water()
+        else:
+            before = None
+
+        try:
+            yield
+        except Exception as e:
+            if is_out_of_memory(e):
+                with self._lock:
+                    self.failures += 1
+                    self._failure_cap = min(self._failure_cap, max(tokens // 2, 1))
+                    self._update()
+            raise
+
+        used = None
+        if self.source == "cuda":
+            used = torch.cuda.max_memory_allocated() - before
+        elif before is not None:
+            peak = self._high_water()
+            with self._lock:
+                if peak > self._peak:
+                    used = peak - before
+                    self._peak = peak
+        if used and used > 0:
+            with self._lock:
+                self.bytes_per_token = max(self.bytes_per_token, used / tokens)
+                self._update()
+
+    def _update(self):
+        limit = self.max_tokens
+        if self.budget and self.bytes_per_token:
+            limit = min(int(self.budget / self.bytes_per_token), self.ceiling)
+        self.max_tokens = max(min(limit, self._failure_cap), 1)
+
+    def stats(self) -> dict:
+        stats = {
+            "max_tokens": self.max_tokens,
+            "budget_bytes": self.budget,
+            "bytes_per_token": round(self.bytes_per_token),
+            "failures": self.failures,
+            "measured_by": self.source,
+            "adaptive": bool(self.budget and self.source),
+        }
+        if not self.budget:
+            stats["note"] = "no free-memory reading on this host; set EMBED_MEMORY_BUDGET_MB to size micro-batches"
+        elif not self.source:
+            stats["note"] = f"no memory measurement on {_device}; the limit only drops after out-of-memory errors"
+        return stats
+
+def is_out_of_memory(e: Exception) -> bool:
+    """Allocation failures from the CUDA, MPS and CPU allocators"""
+    return isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)) or any(
+        marker in str(e) for marker in ("out of memory", "can't allocate memory", "Cannot allocate memory")
+    )
+
+_batch_limit = BatchMemoryLimit(MAX_BATCH_TOKENS, MAX_ADAPTIVE_BATCH_TOKENS)
+
+def split_batch(batch: List[int], batches: List[List[int]]) -> bool:
+    """Put the two halves of a micro-batch back at the front of the plan; False for a single segment"""
+    if len(batch) < 2:
+        return False
+    half = len(batch) // 2
+    batches[:0] = [batch[:half], batch[half:]]
+    return True
+
+def model_info() -> dict:
+    """What /health reports about the loaded model (sent by pool workers when ready)"""
+    return {
+        "width": embedding_dim(0),
+        "device": _device,
+        "precision": CPU_PRECISION if _device == "cpu" else str(model_dtype()).replace("torch.", ""),
+        "projection": _projection_id or None,
+        "hidden_layer": HIDDEN_LAYER,
+        "backend": _backend,
+        "backend_parity": _backend_parity,
+        "parity": _parity,
+    }
+
+def write_parity_reference(path: str):
+    """Embed REFERENCE_TEXTS at full width and save them as the fp32 reference set"""
+    embeddings, _, errors = generate_embeddings_sync(REFERENCE_TEXTS, True, 0)
+    if errors:
+        raise RuntimeError(f"Could not embed reference texts: {errors}")
+    np.savez(path, texts=np.array(REFERENCE_TEXTS), embeddings=embeddings)
+    print(f"Wrote {len(REFERENCE_TEXTS)} reference embeddings to {path}")
+
+def check_parity(path: str):
+    """Embed the reference texts in the current mode and report cosine drift against fp32"""
+    global _parity
+
+    reference = np.load(path)
+    embeddings, _, errors = generate_embeddings_sync([str(t) for t in reference["texts"]], True, 0)
+    if errors:
+        raise RuntimeError(f"Could not embed reference texts: {errors}")
+    cosines = (embeddings * reference["embeddings"]).sum(axis=1)
+
+    _parity = {
+        "reference": os.path.basename(path),
+        "texts": len(cosines),
+        "mean_cosine": float(cosines.mean()),
+        "min_cosine": float(cosines.min()),
+        "max_drift": float(1.0 - cosines.min()),
+    }
+    print(f"Parity vs fp32: mean cosine {_parity['mean_cosine']:.5f}, min {_parity['min_cosine']:.5f}")
+
+def load_projection(path: str):
+    """Load a (hidden_size, k) projection, columns by importance, from .npy or .npz ("components", "mean")"""
+    global _projection, _projection_mean, _projection_id
+
+    data = np.load(path)
+    if isinstance(data, np.ndarray):
+        components, mean = data, None
+    else:
+        components = data["components"]
+        mean = data["mean"] if "mean" in data.files else None
+
+    hidden_size = getattr(_model.config, "text_config", _model.config).hidden_size
+    if components.shape[0] != hidden_size:
+        raise ValueError(f"Projection expects {components.shape[0]} input dims, model has {hidden_size}")
+
+    _projection = torch.from_numpy(np.asarray(components, dtype=np.float32)).to(_device)
+    _projection_mean = torch.from_numpy(np.asarray(mean, dtype=np.float32)).to(_device) if mean is not None else None
+    with open(path, "rb") as f:
+        _projection_id = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    print(f"Loaded projection {components.shape[0]} -> {components.shape[1]} dims from {path}")
+
+def plan_micro_batches(lengths: List[int], max_batch_tokens: int, max_batch_size: int) -> List[List[int]]:
+    """Group item indices into length-sorted micro-batches of at most max_batch_tokens padded tokens"""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+    batches = []
+    current = []
+    longest = 0
+    for i in order:
+        padded = (len(current) + 1) * max(longest, lengths[i])
+        if current and (len(current) >= max_batch_size or padded > max_batch_tokens):
+            batches.append(current)
+            current = []
+            longest = 0
+        current.append(i)
+        longest = max(longest, lengths[i])
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+def mean_pool(hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """Mean pooling over real tokens only, so padding doesn't skew the vector"""
+    mask = attention_mask.unsqueeze(-1).to(torch.float32)
+    summed = (hidden_states.to(torch.float32) * mask).sum(dim=1)
+    return summed / mask.sum(dim=1).clamp(min=1.0)
+
+def last_token_pool(hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    """Hidden state of each row's last real token (the appended EOS), for either padding side"""
+    last = attention_mask.shape[1] - 1 - attention_mask.flip(1).argmax(dim=1)
+    return hidden_states[torch.arange(hidden_states.shape[0], device=hidden_states.device), last].to(torch.float32)
+
+def pool_hidden(hidden_states: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+    return last_token_pool(hidden_states, attention_mask) if POOLING == "last" else mean_pool(hidden_states, attention_mask)
+
+def template_parts(mode: str) -> Tuple[str, str]:
+    """(prefix, suffix) around the input text for a mode; both empty for raw text"""
+    prefix, _, suffix = MODE_TEMPLATES.get(mode, "{text}").partition("{text}")
+    return prefix, suffix
+
+def embedding_variant(mode: str) -> str:
+    """Cache-key component for everything besides the text that changes a vector: template and pooling"""
+    if POOLING == "mean" and template_parts(mode) == ("", ""):
+        return ""
+    # v2: templated texts before it were tokenized apart from the prefix, so their vectors are never reused
+    return f"{POOLING}\0{MODE_TEMPLATES.get(mode, '{text}')}\0v2"
+
+def vector_settings() -> str:
+    """Cache-key component for the settings that change every vector: the hidden layer and long-text windowing"""
+    return f"layer={HIDDEN_LAYER}\0windows={MAX_TEXT_TOKENS},{WINDOW_OVERLAP},{MAX_WINDOWS},{WINDOW_POOLING}"
+
+_prefix_caches = {}
+_prefix_lock = threading.Lock()
+
+def prefix_cache(prefix_ids: Tuple[int, ...], interactive: bool = False):
+    """KV cache for an instruction prefix, computed once per prefix and copied for each micro-batch"""
+    with _prefix_lock:
+        cache = _prefix_caches.get(prefix_ids)
+        if cache is None:
+            with _forward_gate.hold(interactive), inference_context():
+                outputs = encoder()(input_ids=torch.tensor([prefix_ids], device=_device), use_cache=True)
+            cache = _prefix_caches[prefix_ids] = outputs.past_key_values
+    return cache
+
+def embedding_dim(output_dim: int) -> int:
+    """Width of the returned vectors: output_dim, capped at the model's (or projection's) width"""
+    if _projection is not None:
+        width = _projection.shape[1]
+    else:
+        width = getattr(_model.config, "text_config", _model.config).hidden_size
+    return min(output_dim, width) if output_dim else width
+
+def reduce_dimensions(pooled: torch.Tensor, normalize: bool, output_dim: int) -> torch.Tensor:
+    """Project (or truncate) pooled vectors to output_dim on their device, then normalize"""
+    dim = embedding_dim(output_dim)
+
+    if _projection is not None:
+        if _projection_mean is not None:
+            pooled = pooled - _projection_mean.to(pooled.device)
+        pooled = pooled @ _projection[:, :dim].to(pooled.device)
+    elif pooled.shape[-1] > dim:
+        pooled = pooled[:, :dim]
+
+    if normalize:
+        pooled = torch.nn.functional.normalize(pooled, p=2, dim=-1)
+
+    return pooled
+
+def split_windows(ids: List[int], window: int, overlap: int, max_windows: int) -> Tuple[List[List[int]], int]:
+    """Split token ids into overlapping windows; returns the windows and how many tokens were dropped"""
+    if len(ids) <= window:
+        return [ids], 0
+
+    step = max(window - overlap, 1)
+    windows = []
+    start = 0
+    while True:
+        windows.append(ids[start:start + window])
+        if start + window >= len(ids) or len(windows) >= max_windows:
+            break
+        start += step
+
+    return windows, max(len(ids) - (start + window), 0)
+
+def window_summary(stats: np.ndarray) -> Dict[str, int]:
+    """Aggregate per-text [tokens, windows, truncated tokens] rows for a response"""
+    return {
+        "tokens": int(stats[:, 0].sum()),
+        "windows": int(stats[:, 1].sum()),
+        "windowed_texts": int((stats[:, 1] > 1).sum()),
+        "truncated_texts": int((stats[:, 2] > 0).sum()),
+        "truncated_tokens": int(stats[:, 2].sum()),
+    }
+
+@dataclass
+class ImageInput:
+    """A preprocessed image (optionally with text), ready to be batched with other inputs"""
+    text: str
+    pixel_values: np.ndarray
+    grid_thw: Tuple[int, int, int]
+    digest: str
+
+    def cache_text(self) -> str:
+        return f"\0image:{self.digest}\0{self.text}"
+
+def bucket_size(width: int, height: int) -> Tuple[int, int]:
+    """Resize target for an image: longest side to the smallest bucket that fits, sides snapped to the factor"""
+    longest = max(width, height)
+    target = next((b for b in IMAGE_BUCKETS if b >= longest), IMAGE_BUCKETS[-1])
+    scale = target / longest
+
+    def snap(side: int) -> int:
+        return max(IMAGE_SIZE_FACTOR, round(side * scale / IMAGE_SIZE_FACTOR) * IMAGE_SIZE_FACTOR)
+
+    return snap(width), snap(height)
+
+def image_processor():
+    """The model's image processor; loaded on its own when the model lives in pool workers"""
+    global _image_processor
+    if _processor is not None:
+        return _processor.image_processor
+    if _image_processor is None:
+        from transformers import AutoProcessor
+        _image_processor = AutoProcessor.from_pretrained(MODEL_NAME, trust_remote_code=True).image_processor
+    return _image_processor
+
+def image_root_path(image: str) -> Optional[str]:
+    """The real path of image when it names a file inside IMAGE_ROOT, else None"""
+    if not IMAGE_ROOT:
+        return None
+    try:
+        root = os.path.realpath(IMAGE_ROOT)
+        path = os.path.realpath(os.path.join(root, image))
+    except (ValueError, OSError):
+        return None
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+def read_image_bytes(image: str) -> bytes:
+    """Image bytes from a file path under IMAGE_ROOT, a data: URI or a bare base64 string"""
+    if image.startswith("data:"):
+        return base64.b64decode(image.split(",", 1)[1])
+    path = image_root_path(image)
+    if path is not None:
+        with open(path, "rb") as f:
+            return f.read()
+    try:
+        return base64.b64decode(image, validate=True)
+    except ValueError:
+        # The same message whether or not a path exists, so requests can't probe the filesystem
+        raise ValueError("image is not a file under EMBED_IMAGE_ROOT or valid base64")
+
+def load_image(image: str):
+    """Read, decode and bucket-resize one image; runs on the image preprocessing pool"""
+    from PIL import Image
+
+    with _metrics.timer("embed_image_preprocess_seconds"):
+        data = read_image_bytes(image)
+        picture = Image.open(io.BytesIO(data)).convert("RGB")
+        picture = picture.resize(bucket_size(*picture.size), Image.BICUBIC)
+    return picture, hashlib.sha256(data).hexdigest()
+
+def patchify_images(texts: List[str], pictures: List, digests: List[str]) -> List[ImageInput]:
+    """Patchify a request's images in one image processor call and split the patches back per image"""
+    with _metrics.timer("embed_image_patchify_seconds"):
+        processed = image_processor()(images=pictures, return_tensors="np")
+
+    grids = [tuple(int(n) for n in grid) for grid in processed["image_grid_thw"]]
+    offsets = np.cumsum([int(np.prod(grid)) for grid in grids])[:-1]
+    return [ImageInput(text=text, pixel_values=pixel_values, grid_thw=grid, digest=digest)
+            for text, pixel_values, grid, digest
+            in zip(texts, np.split(processed["pixel_values"], offsets), grids, digests)]
+
+def embed_images(items: List[ImageInput], normalize: bool, output_dim: int, interactive: bool = False,
+                 mode: str = "") -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+    """Embed preprocessed images (with their text and mode template) in length-bucketed micro-batches"""
+    embeddings = np.zeros((len(items), embedding_dim(output_dim)), dtype=np.float32)
+    stats = np.zeros((len(items), 3), dtype=np.int64)
+    errors = {}
+
+    merge_length = _processor.image_processor.merge_size ** 2
+    image_token = getattr(_processor, "image_token", "<|image_pad|>")
+    vision_start = getattr(_processor, "vision_start_token", "<|vision_start|>")
+    vision_end = getattr(_processor, "vision_end_token", "<|vision_end|>")
+
+    prefix, suffix = template_parts(mode)
+    if POOLING == "last":
+        suffix += _processor.tokenizer.eos_token
+
+    prompts = []
+    lengths = []
+    texts = [prefix + item.text + suffix for item in items]
+    text_lengths = [len(ids) for ids in _processor.tokenizer(texts)["input_ids"]]
+    for item, text_length in zip(items, text_lengths):
+        image_tokens = int(np.prod(item.grid_thw)) // merge_length
+        prompts.append(prefix + vision_start + image_token * image_tokens + vision_end + item.text + suffix)
+        lengths.append(image_tokens + 2 + text_length)
 
     with torch.no_grad():
-        for text in texts:
+        batches = plan_micro_batches(lengths, _batch_limit.max_tokens, MAX_BATCH_SIZE)
+        while batches:
+            batch = batches.pop(0)
+            tokens = len(batch) * max(lengths[k] for k in batch)
+            if tokens > _batch_limit.max_tokens and split_batch(batch, batches):
+                continue
             try:
-                # Skip empty texts
-                if not text or not text.strip():
-                    embeddings.append([0.0] * output_dim)
-                    continue
+                with _metrics.timer("embed_tokenize_seconds"):
+                    inputs = _processor(text=[prompts[k] for k in batch], padding=True, return_tensors="pt")
+                inputs["pixel_values"] = torch.from_numpy(np.concatenate([items[k].pixel_values for k in batch]))
+                inputs["image_grid_thw"] = torch.tensor([items[k].grid_thw for k in batch])
+
+                _metrics.observe("embed_batch_size", len(batch))
+                _metrics.observe("embed_batch_tokens", inputs["input_ids"].numel())
+
+                inputs = {k: v.to(_device) for k, v in inputs.items()}
+
+                with _batch_limit.measure(inputs["input_ids"].numel()), _forward_gate.hold(interactive), \
+                        _metrics.timer("embed_forward_seconds"), inference_context():
+                    outputs = encoder()(**inputs, use_cache=False)
+
+                with _metrics.timer("embed_pool_seconds"):
+                    pooled = pool_hidden(outputs.last_hidden_state, inputs["attention_mask"])
+                    reduced = reduce_dimensions(pooled, normalize, output_dim)
 
-                # Process single text
-                inputs = _processor(
-                    text=text,
+                with _metrics.timer("embed_to_host_seconds"):
+                    embeddings[batch] = reduced.cpu().numpy()
+                for k in batch:
+                    stats[k] = (lengths[k], 1, 0)
+            except Exception as e:
+                print(f"Error processing batch of {len(batch)} images: {str(e)[:100]}")
+                _metrics.inc("embed_errors_total", stage="batch")
+                if not split_batch(batch, batches):
+                    _metrics.inc("embed_errors_total", stage="item")
+                    errors[batch[0]] = str(e)[:200]
+
+    return embeddings, stats, errors
+
+EMPTY_TEXT_ERROR = "empty text"
+
+def generate_embeddings_sync(texts: List, normalize: bool, output_dim: int, interactive: bool = False,
+                             mode: str = "") -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+    """Generate embeddings for a batch of texts (and ImageInputs).
+
+    Returns vectors, per-text [tokens, windows, truncated tokens], and {index: error} (those rows are zero).
+    """
+    global _model, _processor, _device
+
+    embeddings = np.zeros((len(texts), embedding_dim(output_dim)), dtype=np.float32)
+    stats = np.zeros((len(texts), 3), dtype=np.int64)
+    errors = {}
+
+    images = [i for i, text in enumerate(texts) if isinstance(text, ImageInput)]
+    if images:
+        embeddings[images], stats[images], image_errors = embed_images(
+            [texts[i] for i in images], normalize, output_dim, interactive, mode
+        )
+        errors.update((images[k], message) for k, message in image_errors.items())
+
+    # Empty texts have nothing to embed; report them instead of returning zero vectors
+    indices = []
+    for i, text in enumerate(texts):
+        if isinstance(text, str) and text.strip():
+            indices.append(i)
+        elif not isinstance(text, ImageInput):
+            errors[i] = EMPTY_TEXT_ERROR
+    if not indices:
+        return embeddings, stats, errors
+
+    # Tokenize the whole request once, each text inside its full prompt; each micro-batch is padded separately.
+    # The cached prefix stops before trailing whitespace, which byte-level BPE merges into the text's first token.
+    tokenize_start = time.perf_counter()
+    prefix, suffix = template_parts(mode)
+    input_ids = _processor.tokenizer([prefix + texts[i] + suffix for i in indices])["input_ids"]
+    cached_prefix = prefix.rstrip()
+    prefix_ids = tuple(_processor.tokenizer(cached_prefix, add_special_tokens=False)["input_ids"]) if cached_prefix else ()
+    tokenize_seconds = time.perf_counter() - tokenize_start
+
+    # Flatten into segments: a short text is one segment, a long one is a segment per window.
+    # Texts whose prompt doesn't start with the prefix's tokens are encoded in full, pooling only after the prefix.
+    segment_ids = []
+    segment_owner = []
+    segment_cached = []
+    segment_skip = []
+    windowed = set()
+    for j, ids in enumerate(input_ids):
+        skip = 0
+        cached = bool(prefix_ids) and len(ids) > len(prefix_ids) and tuple(ids[:len(prefix_ids)]) == prefix_ids
+        if cached:
+            ids = ids[len(prefix_ids):]
+        elif prefix_ids:
+            _metrics.inc("embed_prefix_fallbacks_total")
+            skip = next((k for k, (a, b) in enumerate(zip(ids, prefix_ids)) if a != b), len(prefix_ids))
+        windows, truncated = split_windows(ids, MAX_TEXT_TOKENS, WINDOW_OVERLAP, MAX_WINDOWS)
+        stats[indices[j]] = (len(ids) - skip, len(windows), truncated)
+        if len(windows) > 1:
+            windowed.add(j)
+        if POOLING == "last":
+            windows = [window + [_processor.tokenizer.eos_token_id] for window in windows]
+        segment_ids.extend(windows)
+        segment_owner.extend([j] * len(windows))
+        segment_cached.extend([cached] * len(windows))
+        segment_skip.extend([min(skip, len(windows[0]) - 1)] + [0] * (len(windows) - 1))
+
+    lengths = [len(ids) for ids in segment_ids]
+    window_sums = {}
+    window_weights = {}
+    failed = set()
+
+    with torch.no_grad():
+        # Prefix-cached and fully encoded segments never share a micro-batch
+        batches = []
+        for cached in (True, False):
+            group = [k for k in range(len(segment_ids)) if segment_cached[k] == cached]
+            if group:
+                planned = plan_micro_batches([lengths[k] for k in group], _batch_limit.max_tokens, MAX_BATCH_SIZE)
+                batches.extend([group[i] for i in batch] for batch in planned)
+        while batches:
+            batch = batches.pop(0)
+            # The limit may have dropped since planning (a failure, or a new memory peak)
+            if len(batch) * max(lengths[k] for k in batch) > _batch_limit.max_tokens and split_batch(batch, batches):
+                continue
+            try:
+                pad_start = time.perf_counter()
+                inputs = _processor.tokenizer.pad(
+                    {"input_ids": [segment_ids[k] for k in batch]},
+                    padding=True,
+                    padding_side="right" if prefix_ids else None,
                     return_tensors="pt"
                 )
+                tokenize_seconds += time.perf_counter() - pad_start
+
+                _metrics.observe("embed_batch_size", len(batch))
+                _metrics.observe("embed_batch_tokens", inputs["input_ids"].numel())
 
                 # Move to device
-                inputs = {k: v.to(_device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+                inputs = {k: v.to(_device) for k, v in inputs.items()}
 
-                # Generate embedding from hidden states
-                outputs = _model(**inputs, output_hidden_states=True)
+                # Continue from the instruction prefix's KV cache, positioned after it
+                cached = segment_cached[batch[0]]
+                if cached:
+                    size, length = inputs["input_ids"].shape
+                    past = copy.deepcopy(prefix_cache(prefix_ids, interactive))
+                    past.batch_repeat_interleave(size)
+                    forward_kwargs = dict(
+                        attention_mask=torch.cat([
+                            torch.ones(size, len(prefix_ids), dtype=inputs["attention_mask"].dtype, device=_device),
+                            inputs["attention_mask"]
+                        ], dim=1),
+                        position_ids=torch.arange(len(prefix_ids), len(prefix_ids) + length, device=_device).expand(size, -1),
+                        past_key_values=past,
+                        use_cache=True
+                    )
+                else:
+                    forward_kwargs = dict(attention_mask=inputs["attention_mask"], use_cache=False)
 
-                if outputs.hidden_states is None:
-                    print(f"Warning: No hidden states for text: {text[:50]}...")
-                    embeddings.append([0.0] * output_dim)
-                    continue
+                # Generate embeddings from the base transformer's last kept layer (on the compiled backend, if any)
+                with _batch_limit.measure(inputs["input_ids"].numel()), _forward_gate.hold(interactive), \
+                        _metrics.timer("embed_forward_seconds"), inference_context():
+                    if _text_encoder is not None and not cached:
+                        hidden = _text_encoder(inputs["input_ids"], inputs["attention_mask"]).to(_device)
+                    else:
+                        hidden = encoder()(input_ids=inputs["input_ids"], **forward_kwargs).last_hidden_state
+
+                # Single-segment texts are finished; only the reduced vectors leave the device
+                rows = [r for r, k in enumerate(batch) if segment_owner[k] not in windowed]
+                pool_mask = inputs["attention_mask"]
+                if any(segment_skip[k] for k in batch):
+                    pool_mask = pool_mask.clone()
+                    for r, k in enumerate(batch):
+                        pool_mask[r, :segment_skip[k]] = 0
+                with _metrics.timer("embed_pool_seconds"):
+                    pooled = pool_hidden(hidden, pool_mask)
+                    reduced = reduce_dimensions(pooled[rows], normalize, output_dim) if rows else None
+
+                if reduced is not None:
+                    with _metrics.timer("embed_to_host_seconds"):
+                        embeddings[[indices[segment_owner[batch[r]]] for r in rows]] = reduced.cpu().numpy()
+
+                # Windows accumulate until every window of their text has been through
+                for r, k in enumerate(batch):
+                    j = segment_owner[k]
+                    if j in windowed:
+                        weight = float(lengths[k]) if WINDOW_POOLING == "weighted" else 1.0
+                        window_sums[j] = window_sums.get(j, 0) + weight * pooled[r]
+                        window_weights[j] = window_weights.get(j, 0) + weight
+            except Exception as e:
+                print(f"Error processing batch of {len(batch)} texts: {str(e)[:100]}")
+                _metrics.inc("embed_errors_total", stage="batch")
+                if not split_batch(batch, batches):
+                    _metrics.inc("embed_errors_total", stage="item")
+                    failed.add(segment_owner[batch[0]])
+                    errors[indices[segment_owner[batch[0]]]] = str(e)[:200]
+
+        # Pool each long text's windows into one vector, then reduce them together
+        pooled_texts = sorted(windowed - failed)
+        if pooled_texts:
+            with _metrics.timer("embed_pool_seconds"):
+                pooled = torch.stack([window_sums[j] / window_weights[j] for j in pooled_texts])
+                reduced = reduce_dimensions(pooled, normalize, output_dim)
+            with _metrics.timer("embed_to_host_seconds"):
+                embeddings[[indices[j] for j in pooled_texts]] = reduced.cpu().numpy()
+
+    _metrics.observe("embed_tokenize_seconds", tokenize_seconds)
+    return embeddings, stats, errors
+
+class DiskEmbeddingStore:
+    """Append-only float32 vector file, memory-mapped for reads, indexed by index.log"""
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self._data_path = os.path.join(path, "vectors.f32")
+        self._index_path = os.path.join(path, "index.log")
+        self._index = {}
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3:
+                        self._index[parts[0]] = (int(parts[1]), int(parts[2]))
+
+        self._data = open(self._data_path, "ab")
+        self._index_file = open(self._index_path, "a")
+        self._size = os.path.getsize(self._data_path)
+        self._mmap = None
+        self._mapped = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+
+        offset, dim = entry
+        if offset + dim * 4 > self._mapped:
+            self._remap()
+        return np.frombuffer(self._mmap, dtype="<f4", count=dim, offset=offset).copy()
+
+    def put(self, key: str, vector: np.ndarray):
+        if key in self._index:
+            return
+
+        data = np.ascontiguousarray(vector, dtype="<f4").tobytes()
+        offset = self._size
+        self._data.write(data)
+        self._data.flush()
+        self._size += len(data)
+
+        self._index_file.write(f"{key} {offset} {len(vector)}\n")
+        self._index_file.flush()
+        self._index[key] = (offset, len(vector))
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self._data_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped = len(self._mmap)
+
+class EmbeddingCache:
+    """Content-addressed embedding cache: bounded in-memory LRU in front of an optional disk store"""
+
+    def __init__(self, max_entries: int, disk_path: str = ""):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = DiskEmbeddingStore(disk_path) if disk_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, normalize: bool, output_dim: int, instruction: str = "") -> str:
+        # Layer and windowing are part of the key, so a disk cache never mixes vectors across settings
+        digest = hashlib.sha256(f"{MODEL_NAME}\0{_projection_id}\0{vector_settings()}\0{normalize}\0{output_dim}\0".encode())
+        if instruction:
+            digest.update(f"{instruction}\0".encode("utf-8"))
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            if self._disk is not None:
+                vector = self._disk.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, vector: np.ndarray):
+        vector = np.array(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None:
+                self._disk.put(key, vector)
 
-                hidden_states = outputs.hidden_states[-1]
+    def _remember(self, key: str, vector: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
 
-                # Mean pooling
-                embedding = hidden_states.mean(dim=1).squeeze()
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "max_entries": self.max_entries,
+            "entries": len(self._entries),
+            "disk_entries": len(self._disk) if self._disk is not None else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
 
-                # Truncate to output_dim if needed
-                if output_dim and embedding.shape[-1] > output_dim:
-                    embedding = embedding[:output_dim]
+class QueryCache:
+    """Small TTL + LRU cache for search-query embeddings, keyed on the NFKC/whitespace-normalized query"""
 
-                # Normalize if requested
-                if normalize:
-                    embedding = torch.nn.functional.normalize(embedding, p=2, dim=-1)
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
 
-                embeddings.append(embedding.cpu().tolist())
+    @staticmethod
+    def normalize_query(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    @staticmethod
+    def key(text: str, normalize: bool, output_dim: int, instruction: str = "") -> str:
+        digest = hashlib.sha256(
+            f"{MODEL_NAME}\0{_projection_id}\0{vector_settings()}\0{normalize}\0{output_dim}\0{instruction}\0".encode()
+        )
+        digest.update(QueryCache.normalize_query(text).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, vector: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (np.array(vector, dtype=np.float32), time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+_query_log_lock = threading.Lock()
+
+def record_queries(texts: List[str], normalize: bool, output_dim: int, mode: str = ""):
+    """Append queries to EMBED_QUERY_LOG for pre-warming, rotating it to .1 at QUERY_LOG_MAX_BYTES"""
+    lines = [
+        json.dumps({"query": text, "normalize": normalize, "output_dim": output_dim, "mode": mode}) + "\n"
+        for text in texts if isinstance(text, str) and text.strip()
+    ]
+    with _query_log_lock:
+        if QUERY_LOG_MAX_BYTES > 0 and os.path.exists(QUERY_LOG) and os.path.getsize(QUERY_LOG) >= QUERY_LOG_MAX_BYTES:
+            os.replace(QUERY_LOG, QUERY_LOG + ".1")
+        with open(QUERY_LOG, "a") as f:
+            f.writelines(lines)
+
+def query_log_files(path: str) -> List[str]:
+    """The rotated and current query log files that exist, oldest first"""
+    return [p for p in (path + ".1", path) if os.path.exists(p)]
+
+def read_query_log(path: str, limit: int) -> List[Tuple[str, bool, int, str]]:
+    """The `limit` most frequent (query, normalize, output_dim, mode) entries of a query log and its rotation"""
+    counts, samples = {}, {}
+    for log_file in query_log_files(path):
+        with open(log_file, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    item = line
+                if isinstance(item, dict):
+                    entry = (
+                        str(item.get("query", "")), bool(item.get("normalize", True)),
+                        int(item.get("output_dim", 4096)), str(item.get("mode") or "")
+                    )
+                else:
+                    entry = (str(item), True, 4096, "")
+                if entry[0].strip():
+                    query_key = (QueryCache.normalize_query(entry[0]),) + entry[1:]
+                    counts[query_key] = counts.get(query_key, 0) + 1
+                    samples.setdefault(query_key, entry)
+    return [samples[key] for key in sorted(counts, key=counts.get, reverse=True)[:limit]]
+
+def prewarm_query_cache(path: str):
+    """Once the model is ready, embed the most frequent logged queries into the query cache"""
+    while readiness() not in ("ready", "failed"):
+        time.sleep(1)
+    if readiness() != "ready" or not query_log_files(path):
+        return
+
+    start = time.time()
+    entries = read_query_log(path, _query_cache.max_entries)
+    groups = {}
+    for query, normalize, output_dim, mode in entries:
+        groups.setdefault((normalize, output_dim, mode), []).append(query)
+
+    for (normalize, output_dim, mode), queries in groups.items():
+        for i in range(0, len(queries), COALESCE_MAX_BATCH):
+            try:
+                embed_texts(
+                    queries[i:i + COALESCE_MAX_BATCH], normalize, output_dim, bounded=False, query=True, mode=mode
+                ).result()
             except Exception as e:
-                print(f"Error processing text: {str(e)[:100]}")
-                embeddings.append([0.0] * output_dim)
+                print(f"Query cache pre-warm failed: {str(e)[:100]}")
+                return
+    print(f"Pre-warmed query cache with {len(entries)} queries in {time.time() - start:.1f}s")
+
+def partition_cores(num_workers: int) -> List[List[int]]:
+    """Split the cores this process may run on into contiguous per-worker slices"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+
+    per_worker = max(len(cores) // num_workers, 1)
+    return [cores[i * per_worker:(i + 1) * per_worker] or cores for i in range(num_workers)]
+
+def worker_main(worker_id: int, cores: List[int], tasks, priority_tasks, results):
+    """Worker process: pin to cores, load the model, and serve bulk and interactive passes"""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    load_model()
+    warm_up()
+    _metrics.log = []
+    results.put(("ready", worker_id, model_info()))
+
+    def serve(task_queue, interactive: bool):
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            run_task(task, interactive)
+
+    def run_task(task, interactive: bool):
+        task_id, texts, normalize, output_dim, mode, shm_name = task
+        start = time.time()
+        try:
+            embeddings, stats, item_errors = generate_embeddings_sync(texts, normalize, output_dim, interactive, mode)
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                np.ndarray(embeddings.shape, dtype=np.float32, buffer=shm.buf)[:] = embeddings
+            finally:
+                shm.close()
+            error = None
+        except Exception as e:
+            stats, item_errors, error = None, None, str(e)[:200]
+        elapsed_ms = (time.time() - start) * 1000
+        results.put((
+            "done", worker_id, task_id, stats, item_errors, error, elapsed_ms, _metrics.drain(), peak_rss_bytes()
+        ))
+
+    threading.Thread(target=serve, args=(priority_tasks, True), name="interactive-tasks", daemon=True).start()
+    serve(tasks, False)
+
+class WorkerPool:
+    """Dispatcher for model-hosting worker processes, one task queue and core slice each"""
+
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        self.info = {}
+        self.ready_seconds = None
+        self._started = time.time()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._next_task = 0
+        self._pending = {}
+        self._workers = []
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self._results = ctx.Queue()
+        self._started = time.time()
+
+        for worker_id, cores in enumerate(partition_cores(self.num_workers)):
+            tasks = ctx.Queue()
+            priority_tasks = ctx.Queue()
+            process = ctx.Process(
+                target=worker_main,
+                args=(worker_id, cores, tasks, priority_tasks, self._results),
+                name=f"embedding-worker-{worker_id}",
+                daemon=True
+            )
+            process.start()
+            self._workers.append({
+                "process": process,
+                "tasks": tasks,
+                "priority_tasks": priority_tasks,
+                "cores": cores,
+                "ready": False,
+                "ready_seconds": None,
+                "in_flight": 0,
+                "passes": 0,
+                "texts": 0,
+                "busy_ms": 0.0,
+                "errors": 0,
+            })
+
+        threading.Thread(target=self._collect, name="embedding-pool-collector", daemon=True).start()
+
+    def submit(self, texts: List[str], normalize: bool, output_dim: int, interactive: bool = False,
+               mode: str = "") -> Future:
+        """Run one pass on the least loaded ready worker (on its priority queue when interactive)"""
+        while not self._ready.wait(timeout=1.0):
+            if not any(w["process"].is_alive() for w in self._workers):
+                raise RuntimeError("All embedding workers exited before becoming ready")
+        width = self.info["width"]
+        dim = min(output_dim, width) if output_dim else width
+        shm = shared_memory.SharedMemory(create=True, size=max(len(texts) * dim * 4, 1))
+        future = Future()
+
+        with self._lock:
+            task_id = self._next_task
+            self._next_task += 1
+            worker_id = min(
+                (i for i, w in enumerate(self._workers) if w["ready"]),
+                key=lambda i: (self._workers[i]["in_flight"], self._workers[i]["passes"])
+            )
+            worker = self._workers[worker_id]
+            worker["in_flight"] += 1
+            self._pending[task_id] = (future, shm, (len(texts), dim), worker_id)
+
+        worker["priority_tasks" if interactive else "tasks"].put((task_id, texts, normalize, output_dim, mode, shm.name))
+        return future
+
+    def _collect(self):
+        while True:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                continue
+
+            if message[0] == "ready":
+                global _projection_id
+                _, worker_id, info = message
+                _projection_id = info["projection"] or ""
+                elapsed = time.time() - self._started
+                with self._lock:
+                    self._workers[worker_id]["ready"] = True
+                    self._workers[worker_id]["ready_seconds"] = round(elapsed, 1)
+                    self.info = info
+                    if self.ready_seconds is None:
+                        self.ready_seconds = elapsed
+                print(f"Worker {worker_id} ready on cores {self._workers[worker_id]['cores']} in {elapsed:.1f}s")
+                self._ready.set()
+                continue
+
+            _, worker_id, task_id, stats, item_errors, error, elapsed_ms, observations, rss = message
+            _metrics.replay(observations)
+            _metrics.worker_rss[worker_id] = rss
+            with self._lock:
+                future, shm, shape, _ = self._pending.pop(task_id)
+                worker = self._workers[worker_id]
+                worker["in_flight"] -= 1
+                worker["passes"] += 1
+                worker["texts"] += shape[0]
+                worker["busy_ms"] += elapsed_ms
+                if error is not None:
+                    worker["errors"] += 1
+                    _metrics.inc("embed_errors_total", stage="worker")
+
+            try:
+                if error is not None:
+                    future.set_exception(RuntimeError(f"Worker {worker_id}: {error}"))
+                else:
+                    embeddings = np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+                    future.set_result((embeddings, stats, item_errors))
+            finally:
+                shm.close()
+                shm.unlink()
+
+    def _check_workers(self):
+        """Fail the in-flight passes of any worker that has died"""
+        with self._lock:
+            for worker_id, worker in enumerate(self._workers):
+                if worker["process"].is_alive() or not worker["ready"]:
+                    continue
+                worker["ready"] = False
+                print(f"Worker {worker_id} exited with code {worker['process'].exitcode}")
+                for task_id, (future, shm, _, owner) in list(self._pending.items()):
+                    if owner == worker_id:
+                        del self._pending[task_id]
+                        shm.close()
+                        shm.unlink()
+                        future.set_exception(RuntimeError(f"Worker {worker_id} exited"))
+
+    def state(self) -> str:
+        if self._ready.is_set():
+            return "ready"
+        if self._workers and not any(w["process"].is_alive() for w in self._workers):
+            return "failed"
+        return "loading"
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "id": worker_id,
+                    "pid": worker["process"].pid,
+                    "alive": worker["process"].is_alive(),
+                    "ready": worker["ready"],
+                    "ready_seconds": worker["ready_seconds"],
+                    "cores": worker["cores"],
+                    "threads": len(worker["cores"]),
+                    "in_flight": worker["in_flight"],
+                    "passes": worker["passes"],
+                    "texts": worker["texts"],
+                    "busy_ms": round(worker["busy_ms"], 1),
+                    "errors": worker["errors"],
+                }
+                for worker_id, worker in enumerate(self._workers)
+            ]
+
+_pool = WorkerPool(WORKERS) if WORKERS > 0 else None
+_inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="embed-inference")
+_interactive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-interactive")
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="embed-image")
+
+def run_pass(texts: List[str], normalize: bool, output_dim: int, interactive: bool = False,
+             mode: str = "") -> Future:
+    """Run one batched pass on the inference executor, or on a pool worker when EMBED_WORKERS is set"""
+    try:
+        if _pool is not None:
+            return _pool.submit(texts, normalize, output_dim, interactive, mode)
+        executor = _interactive_executor if interactive else _inference_executor
+        return executor.submit(generate_embeddings_sync, texts, normalize, output_dim, interactive, mode)
+    except Exception as e:
+        future = Future()
+        future.set_exception(e)
+        return future
+
+@dataclass
+class PendingEmbedding:
+    texts: List[str]
+    normalize: bool
+    output_dim: int
+    future: Future
+    enqueued: float = 0.0
+    lane: str = "bulk"
+    mode: str = ""
+
+class Overloaded(Exception):
+    """The batcher queue is full; retry_after is an estimate of when it will have drained, in seconds"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Embedding queue full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class EmbeddingBatcher:
+    """Background bulk and interactive queues that coalesce texts from concurrent requests into shared passes"""
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float, concurrency: int = 1, max_queued_texts: int = 0):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queued_texts = max_queued_texts
+        self.concurrency = concurrency
+        self._seconds_per_text = 0.0
+        self._slots = threading.Semaphore(concurrency)
+        self._queues = {lane: queue.Queue() for lane in LANES}
+        self._lock = threading.Lock()
+        self._queued_texts = {lane: 0 for lane in LANES}
+        self._threads = []
+        self.batches_run = 0
+        self.requests_served = 0
+        self.texts_embedded = 0
+        self.requests_rejected = 0
+
+    def start(self):
+        if not self._threads:
+            for target, lane in ((self._run, "bulk"), (self._run_interactive, "interactive")):
+                thread = threading.Thread(target=target, name=f"embedding-batcher-{lane}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, texts: List[str], normalize: bool, output_dim: int, bounded: bool = True,
+               lane: str = "bulk", mode: str = "") -> Future:
+        """Queue texts for embedding; raises Overloaded when bounded and the lane's queue is full"""
+        future = Future()
+        with self._lock:
+            queued = self._queued_texts[lane]
+            if bounded and self.max_queued_texts and queued and queued + len(texts) > self.max_queued_texts:
+                self.requests_rejected += 1
+                raise Overloaded(self.retry_after())
+            self._queued_texts[lane] += len(texts)
+        self._queues[lane].put(PendingEmbedding(texts, normalize, output_dim, future, time.monotonic(), lane, mode))
+        return future
+
+    def check_capacity(self, lane: str = "bulk"):
+        """Raise Overloaded if the lane's queue is already full"""
+        with self._lock:
+            if self.max_queued_texts and self._queued_texts[lane] >= self.max_queued_texts:
+                self.requests_rejected += 1
+                raise Overloaded(self.retry_after())
+
+    def retry_after(self) -> int:
+        """Seconds until the queued texts should have drained, from recent per-text pass time"""
+        seconds = sum(self._queued_texts.values()) * self._seconds_per_text / self.concurrency
+        return min(max(math.ceil(seconds), 1), 60)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "max_queued_texts": self.max_queued_texts,
+            "queue_depth": sum(self._queued_texts.values()),
+            "queued_requests": sum(q.qsize() for q in self._queues.values()),
+            "lanes": {
+                lane: {"queue_depth": self._queued_texts[lane], "queued_requests": self._queues[lane].qsize()}
+                for lane in LANES
+            },
+            "batches_run": self.batches_run,
+            "requests_served": self.requests_served,
+            "texts_embedded": self.texts_embedded,
+            "requests_rejected": self.requests_rejected,
+        }
+
+    def _take(self, lane: str, timeout: Optional[float] = None, block: bool = True) -> PendingEmbedding:
+        item = self._queues[lane].get(block=block, timeout=timeout)
+        with self._lock:
+            self._queued_texts[lane] -= len(item.texts)
+        return item
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            pending = [self._take("bulk")]
+            count = len(pending[0].texts)
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+
+            while count < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._take("bulk", timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                count += len(item.texts)
+
+            self._process(pending, "bulk")
+
+    def _run_interactive(self):
+        while True:
+            pending = [self._take("interactive")]
+            while True:
+                try:
+                    pending.append(self._take("interactive", block=False))
+                except queue.Empty:
+                    break
+            self._process(pending, "interactive")
+
+    def _process(self, pending: List[PendingEmbedding], lane: str):
+        now = time.monotonic()
+        groups = {}
+        for item in pending:
+            _metrics.observe("embed_queue_wait_seconds", now - item.enqueued, lane=lane)
+            groups.setdefault((item.normalize, item.output_dim, item.mode), []).append(item)
+
+        # Bulk: the first group uses the slot taken in _run; each further group takes its own
+        for n, ((normalize, output_dim, mode), items) in enumerate(groups.items()):
+            if n > 0 and lane == "bulk":
+                self._slots.acquire()
+            texts = [text for item in items for text in item.texts]
+            run_pass(texts, normalize, output_dim, lane == "interactive", mode).add_done_callback(
+                partial(self._deliver, items, lane, time.monotonic())
+            )
+
+    def _deliver(self, items: List[PendingEmbedding], lane: str, started: float, inner: Future):
+        if lane == "bulk":
+            self._slots.release()
+        try:
+            embeddings, stats, errors = inner.result()
+        except Exception as e:
+            for item in items:
+                item.future.set_exception(e)
+            return
+
+        offset = 0
+        for item in items:
+            end = offset + len(item.texts)
+            item_errors = {i - offset: message for i, message in errors.items() if offset <= i < end}
+            item.future.set_result((embeddings[offset:end], stats[offset:end], item_errors))
+            offset = end
+
+        # Smoothed pass time per text, for Retry-After estimates
+        if lane == "bulk":
+            per_text = (time.monotonic() - started) / max(offset, 1)
+            self._seconds_per_text = per_text if not self._seconds_per_text else 0.8 * self._seconds_per_text + 0.2 * per_text
+
+        self.batches_run += 1
+        self.requests_served += len(items)
+        self.texts_embedded += offset
+
+_batcher = EmbeddingBatcher(
+    COALESCE_MAX_BATCH, COALESCE_MAX_WAIT_MS, WORKERS or INFERENCE_THREADS, MAX_QUEUED_TEXTS
+)
+_cache = EmbeddingCache(CACHE_MAX_ENTRIES, CACHE_DIR)
+_query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def embed_texts(texts: List[str], normalize: bool, output_dim: int, bounded: bool = True,
+                lane: str = "bulk", query: bool = False, mode: str = "") -> Future:
+    """Resolve cached vectors immediately and queue only the misses; resolves to (vectors, stats, errors)"""
+    cache = _query_cache if query else _cache
+    instruction = embedding_variant(mode)
+    keys = [
+        cache.key(text if isinstance(text, str) else text.cache_text(), normalize, output_dim, instruction)
+        for text in texts
+    ]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(results) if vector is None]
+    stats = np.zeros((len(texts), 3), dtype=np.int64)
+
+    future = Future()
+    if not missing:
+        future.set_result((np.stack(results), stats, {}))
+        return future
+
+    def fill(inner: Future):
+        try:
+            vectors, missing_stats, missing_errors = inner.result()
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        stats[missing] = missing_stats
+        for k, (i, vector) in enumerate(zip(missing, vectors)):
+            results[i] = vector
+            # Zero vectors are empty texts; don't pin them (or failures) in the cache
+            if k not in missing_errors and vector.any():
+                cache.put(keys[i], vector)
+        future.set_result((np.stack(results), stats, {missing[k]: message for k, message in missing_errors.items()}))
+
+    _batcher.submit([texts[i] for i in missing], normalize, output_dim, bounded, lane, mode).add_done_callback(fill)
+    return future
+
+def quantize_embeddings(embeddings: np.ndarray, mode: str):
+    """Quantize a batch of vectors to int8 or packed sign bits, with one scale per vector"""
+    if mode == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        safe = np.where(scales > 0, scales, 1.0)
+        quantized = np.clip(np.rint(embeddings / safe[:, None]), -127, 127).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    scales = np.abs(embeddings).mean(axis=1).astype(np.float32)
+    return np.packbits(embeddings > 0, axis=1), scales
+
+# Raw binary responses: 16-byte header (magic, count, dims, dtype code) then little-endian vectors
+BINARY_MAGIC = b"QVE1"
+BINARY_DTYPES = {"float32": (0, "<f4"), "float16": (1, "<f2"), "int8": (2, "i1"), "binary": (3, "u1")}
+
+def negotiate_encoding(accept: str):
+    """Pick (media type, dtype) from the Accept header; JSON unless a binary type is asked for"""
+    for part in accept.split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        if media_type not in ("application/octet-stream", "application/x-npy"):
+            continue
+
+        dtype = "float32"
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "dtype":
+                dtype = value.strip().strip('"')
+        if dtype not in ("float32", "float16"):
+            raise HTTPException(status_code=406, detail=f"Unsupported dtype: {dtype}")
+        return media_type, dtype
+
+    return "application/json", "float32"
+
+def encode_embeddings(embeddings: np.ndarray, media_type: str, dtype: str,
+                      scales: Optional[np.ndarray] = None, dims: Optional[int] = None) -> bytes:
+    """Serialize vectors (and any per-vector scales) straight from the array buffer"""
+    code, numpy_dtype = BINARY_DTYPES[dtype]
+    data = np.ascontiguousarray(embeddings, dtype=numpy_dtype)
+
+    if media_type == "application/x-npy":
+        buffer = io.BytesIO()
+        np.save(buffer, data, allow_pickle=False)
+        return buffer.getvalue()
+
+    header = struct.pack("<4sIIB3x", BINARY_MAGIC, data.shape[0], dims or data.shape[1], code)
+    parts = [header, memoryview(data)]
+    if scales is not None:
+        parts.append(memoryview(np.ascontiguousarray(scales, dtype="<f4")))
+    return b"".join(parts)
+
+class VectorIndex:
+    """Named IVF index over a memory-mapped float16 or int8 matrix of unit vectors, with incremental adds"""
+
+    DTYPES = {"float16": "<f2", "int8": "i1"}
+    ADD_CHUNK = 8192
+    TRAIN_SAMPLE = 32768
+    TRAIN_ITERATIONS = 10
+    SCORE_CHUNK = 16384
+
+    def __init__(self, path: str, settings: Optional[dict] = None, dtype: str = INDEX_DTYPE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+        self._meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.meta = json.load(f)
+            # Indexes from before the layer was recorded were built from the final layer
+            self.meta["settings"].setdefault("hidden_layer", -1)
+        else:
+            if dtype not in self.DTYPES:
+                raise ValueError(f"Unknown index dtype {dtype!r}; use {' or '.join(self.DTYPES)}")
+            self.meta = {"settings": settings or {}, "dtype": dtype, "dim": None, "trained_rows": 0}
+            write_manifest(self._meta_path, self.meta)
+        self.dtype = self.DTYPES[self.meta["dtype"]]
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._vectors = self._scales = None
+        self._mapped_rows = 0
+
+        self.ids = []
+        valid_bytes = 0
+        ids_path = self._file("ids.jsonl")
+        if os.path.exists(ids_path):
+            with open(ids_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    self.ids.append(json.loads(line))
+                    valid_bytes += len(line)
+        count = len(self.ids)
+        self._rows = {}
+        self._live = np.ones(count, dtype=bool)
+        for row, record_id in enumerate(self.ids):
+            self._supersede(record_id, row, self._live)
+
+        self._ids_file = self._append_file("ids.jsonl", valid_bytes)
+        dim = self.meta["dim"] or 0
+        self._data = self._append_file("vectors.bin", count * dim * np.dtype(self.dtype).itemsize)
+        self._scales_file = self._append_file("scales.f32", count * 4) if self.meta["dtype"] == "int8" else None
+
+        self._centroids = None
+        self._members = []
+        self._lists_file = None
+        if os.path.exists(self._file("centroids.npy")):
+            self._centroids = np.load(self._file("centroids.npy"))
+            self._lists_file = self._append_file("lists.i32", count * 4)
+            lists = np.fromfile(self._file("lists.i32"), dtype="<i4")
+            if len(lists) < count:
+                vectors, scales = self._matrix(count)
+                missing = self._assign(self._rows_float(vectors, scales, np.arange(len(lists), count)), self._centroids)
+                self._lists_file.write(missing.astype("<i4").tobytes())
+                self._lists_file.flush()
+                lists = np.concatenate([lists, missing])
+            self._members = self._group(lists, len(self._centroids))
+
+    @property
+    def output_dim(self) -> int:
+        return self.meta["settings"].get("output_dim") or self.meta["dim"]
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _append_file(self, name: str, size: int):
+        """Open a data file for appending, cut back to the bytes that belong to committed rows"""
+        path = self._file(name)
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            os.truncate(path, size)
+        return open(path, "ab")
+
+    def _supersede(self, record_id, row: int, live: np.ndarray):
+        previous = self._rows.get(record_id)
+        if previous is not None:
+            live[previous] = False
+        self._rows[record_id] = row
+
+    def _matrix(self, count: int):
+        """Read-only maps of the first count rows and their scales, remapped as the files grow"""
+        if count > self._mapped_rows:
+            self._vectors = np.memmap(self._file("vectors.bin"), dtype=self.dtype, mode="r", shape=(count, self.meta["dim"]))
+            if self._scales_file is not None:
+                self._scales = np.memmap(self._file("scales.f32"), dtype="<f4", mode="r", shape=(count,))
+            self._mapped_rows = count
+        return self._vectors, self._scales
+
+    @staticmethod
+    def _rows_float(vectors: np.ndarray, scales: Optional[np.ndarray], rows: np.ndarray) -> np.ndarray:
+        block = vectors[rows].astype(np.float32)
+        if scales is not None:
+            block *= scales[rows][:, None]
+        return block
+
+    def _assign(self, points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(points[i:i + self.SCORE_CHUNK] @ centroids.T, axis=1) for i in range(0, len(points), self.SCORE_CHUNK)
+        ] or [np.empty(0, dtype=np.int64)]).astype(np.int32)
+
+    @staticmethod
+    def _group(lists: np.ndarray, nlist: int) -> List[np.ndarray]:
+        order = np.argsort(lists, kind="stable")
+        bounds = np.searchsorted(lists[order], np.arange(nlist + 1))
+        return [order[bounds[c]:bounds[c + 1]] for c in range(nlist)]
+
+    def add(self, ids: List, vectors: np.ndarray) -> int:
+        """Append vectors (normalized to unit length) under ids; returns the new row count"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(ids):
+            raise ValueError(f"Expected {len(ids)} vectors, got an array of shape {vectors.shape}")
+        if any(not isinstance(record_id, (int, str)) for record_id in ids):
+            raise ValueError("Index ids must be integers or strings")
+        if not len(ids):
+            return len(self.ids)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        if not norms.all():
+            raise ValueError(f"Zero vectors cannot be indexed (ids {[ids[i] for i in np.flatnonzero(norms[:, 0] == 0)][:10]})")
+        vectors = vectors / norms
+
+        with self._write_lock:
+            if self.meta["dim"] is None:
+                self.meta["dim"] = vectors.shape[1]
+                write_manifest(self._meta_path, self.meta)
+            elif vectors.shape[1] != self.meta["dim"]:
+                raise ValueError(f"Index {self.name} holds {self.meta['dim']}-dimensional vectors, got {vectors.shape[1]}")
+
+            if self._scales_file is not None:
+                quantized, scales = quantize_embeddings(vectors, "int8")
+                self._data.write(quantized.tobytes())
+                self._scales_file.write(scales.astype("<f4").tobytes())
+                self._scales_file.flush()
+            else:
+                self._data.write(vectors.astype(self.dtype).tobytes())
+            self._data.flush()
+
+            lists = None
+            if self._centroids is not None:
+                lists = self._assign(vectors, self._centroids)
+                self._lists_file.write(lists.astype("<i4").tobytes())
+                self._lists_file.flush()
+
+            self._ids_file.write("".join(json.dumps(record_id) + "\n" for record_id in ids).encode("utf-8"))
+            self._ids_file.flush()
+
+            with self._lock:
+                start = len(self.ids)
+                live = np.concatenate([self._live, np.ones(len(ids), dtype=bool)])
+                for offset, record_id in enumerate(ids):
+                    self._supersede(record_id, start + offset, live)
+                self.ids.extend(ids)
+                self._live = live
+                if lists is not None:
+                    members = list(self._members)
+                    for c in np.unique(lists):
+                        members[c] = np.concatenate([members[c], start + np.flatnonzero(lists == c)])
+                    self._members = members
+
+            count = len(self.ids)
+            if (len(self._rows) > INDEX_EXACT_MAX_ROWS if self._centroids is None
+                    else count >= 4 * self.meta["trained_rows"]):
+                self._train(count)
+            return count
+
+    def _train(self, count: int):
+        """Spherical k-means over a sample of live rows, then reassign every row to its nearest centroid"""
+        start = time.time()
+        with self._lock:
+            vectors, scales = self._matrix(count)
+            live = np.flatnonzero(self._live[:count])
+        nlist = max(1, min(INDEX_NLIST or int(math.sqrt(len(live))), len(live)))
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(live, min(len(live), self.TRAIN_SAMPLE), replace=False))
+        points = self._rows_float(vectors, scales, sample)
+        centroids = points[rng.choice(len(points), nlist, replace=False)]
+
+        for _ in range(self.TRAIN_ITERATIONS):
+            assignment = self._assign(points, centroids)
+            order = np.argsort(assignment, kind="stable")
+            used, starts = np.unique(assignment[order], return_index=True)
+            sums = np.add.reduceat(points[order], starts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty lists keep their previous centroid
+            centroids[used] = sums / np.where(norms > 0, norms, 1.0)
+
+        lists = np.concatenate([
+            self._assign(self._rows_float(vectors, scales, np.arange(i, min(i + self.SCORE_CHUNK, count))), centroids)
+            for i in range(0, count, self.SCORE_CHUNK)
+        ])
+        lists.astype("<i4").tofile(self._file("lists.i32.tmp"))
+        with open(self._file("centroids.npy.tmp"), "wb") as f:
+            np.save(f, centroids)
+        os.replace(self._file("centroids.npy.tmp"), self._file("centroids.npy"))
+        os.replace(self._file("lists.i32.tmp"), self._file("lists.i32"))
+
+        with self._lock:
+            if self._lists_file is not None:
+                self._lists_file.close()
+            self._lists_file = open(self._file("lists.i32"), "ab")
+            self._centroids = centroids
+            self._members = self._group(lists, nlist)
+        self.meta["trained_rows"] = count
+        write_manifest(self._meta_path, self.meta)
+        print(f"Index {self.name}: trained {nlist} lists on {len(sample)} of {count} rows in {time.time() - start:.1f}s")
+
+    def search(self, query: np.ndarray, k: int, nprobe: int = INDEX_NPROBE) -> Tuple[List[Tuple[object, float]], bool]:
+        """Top-k (id, similarity) pairs for one query vector, best first, and whether every row was scored"""
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm > 0 else query
+
+        with self._lock:
+            count = len(self.ids)
+            if count == 0:
+                return [], True
+            if len(query) != self.meta["dim"]:
+                raise ValueError(f"Index {self.name} holds {self.meta['dim']}-dimensional vectors, got a {len(query)}-dimensional query")
+            vectors, scales = self._matrix(count)
+            live, centroids, members = self._live, self._centroids, self._members
+
+        exact = centroids is None or nprobe >= len(centroids)
+        if exact:
+            candidates = np.flatnonzero(live[:count])
+        else:
+            probe = np.argpartition(-(centroids @ query), max(nprobe, 1) - 1)[:max(nprobe, 1)]
+            candidates = np.sort(np.concatenate([members[c] for c in probe]))
+            candidates = candidates[live[candidates]]
 
-    return embeddings
+        scores = np.concatenate([
+            self._rows_float(vectors, scales, candidates[i:i + self.SCORE_CHUNK]) @ query
+            for i in range(0, len(candidates), self.SCORE_CHUNK)
+        ] or [np.empty(0, dtype=np.float32)])
+        k = min(k, len(scores))
+        if k == 0:
+            return [], exact
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.ids[candidates[i]], float(scores[i])) for i in top], exact
+
+    def stats(self) -> dict:
+        return {
+            "rows": len(self.ids),
+            "live_rows": len(self._rows),
+            "dim": self.meta["dim"],
+            "dtype": self.meta["dtype"],
+            "lists": len(self._centroids) if self._centroids is not None else 0,
+            "trained_rows": self.meta["trained_rows"],
+            "settings": self.meta["settings"],
+        }
+
+_indexes: Dict[str, VectorIndex] = {}
+_indexes_lock = threading.Lock()
+
+def load_indexes(path: str):
+    """Open every index under EMBED_INDEX_DIR that was built with this model and projection"""
+    if not os.path.isdir(path):
+        return
+    for name in sorted(os.listdir(path)):
+        if not os.path.exists(os.path.join(path, name, "meta.json")):
+            continue
+        index = VectorIndex(os.path.join(path, name))
+        settings = index.meta["settings"]
+        if (settings.get("model", MODEL_NAME), settings.get("projection", PROJECTION_PATH), settings["hidden_layer"]) != \
+                (MODEL_NAME, PROJECTION_PATH, HIDDEN_LAYER):
+            print(f"Skipping index {name}: built with {settings.get('model')} (projection "
+                  f"{settings.get('projection') or 'none'}, layer {settings['hidden_layer']}), not {MODEL_NAME} layer {HIDDEN_LAYER}")
+            continue
+        _indexes[name] = index
+        print(f"Loaded index {name}: {len(index.ids)} rows, {index.stats()['lists']} lists")
 
 @app.on_event("startup")
 async def startup_event():
-    """Load model on startup"""
-    load_model()
+    """Start loading the model (in the worker processes when the pool is enabled) without blocking startup"""
+    if _pool is not None:
+        _pool.start()
+    else:
+        threading.Thread(target=start_model, name="model-startup", daemon=True).start()
+    _batcher.start()
+    if INDEX_DIR:
+        load_indexes(INDEX_DIR)
+    if QUERY_LOG:
+        threading.Thread(target=prewarm_query_cache, args=(QUERY_LOG,), name="query-cache-prewarm", daemon=True).start()
+
+def readiness() -> str:
+    return _pool.state() if _pool is not None else _state
+
+def require_ready():
+    """Reject inference with a fast 503 until the model is loaded and warmed up"""
+    state = readiness()
+    if state != "ready":
+        raise HTTPException(status_code=503, detail=f"Model not ready ({state})", headers={"Retry-After": "5"})
+
+def too_many_requests(e: Overloaded) -> HTTPException:
+    """Fast 429 for a full batcher queue, so clients back off instead of piling up"""
+    _metrics.inc("embed_errors_total", stage="overloaded")
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def embedding_failed(errors: Dict[int, str]) -> HTTPException:
+    """400 (all empty inputs) or 500 error listing the inputs that could not be embedded"""
+    client_error = all(message == EMPTY_TEXT_ERROR for message in errors.values())
+    return HTTPException(status_code=400 if client_error else 500, detail={
+        "message": f"{len(errors)} input(s) could not be embedded",
+        "errors": [{"index": i, "error": message} for i, message in sorted(errors.items())],
+    })
+
+def request_lane(http_request: Request, priority: Optional[str], count: int) -> str:
+    """Priority lane from the request field or X-Priority header; single texts default to interactive"""
+    lane = priority or http_request.headers.get("x-priority", "").strip().lower() or ("interactive" if count == 1 else "bulk")
+    if lane not in LANES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority {lane!r}; use one of {', '.join(LANES)}")
+    return lane if count <= INTERACTIVE_MAX_TEXTS else "bulk"
+
+async def embed_request(texts: List[str], normalize: bool, output_dim: int, lane: str = "bulk",
+                        mode: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+    """Await one request's texts on the batched path; a full queue becomes a 429"""
+    mode = mode or ""
+    query = lane == "interactive" or mode == "query"
+    if query and QUERY_LOG:
+        await asyncio.to_thread(record_queries, texts, normalize, output_dim, mode)
+    try:
+        return await asyncio.wrap_future(embed_texts(texts, normalize, output_dim, lane=lane, query=query, mode=mode))
+    except Overloaded as e:
+        raise too_many_requests(e)
+    except Exception:
+        _metrics.inc("embed_errors_total", stage="request")
+        raise
+
+async def prepare_inputs(inputs: List[EmbeddingInput]) -> List:
+    """Turn request inputs into texts and ImageInputs, decoding images on the image pool"""
+    loop = asyncio.get_running_loop()
+    prepared = []
+    for index, item in enumerate(inputs):
+        if item.image:
+            prepared.append(loop.run_in_executor(_image_executor, load_image, item.image))
+        elif item.text is not None:
+            prepared.append(item.text)
+        else:
+            raise HTTPException(status_code=400, detail=f"Input {index} has neither text nor image")
+
+    images = [index for index, item in enumerate(prepared) if isinstance(item, asyncio.Future)]
+    loaded = []
+    for index in images:
+        try:
+            loaded.append(await prepared[index])
+        except Exception as e:
+            _metrics.inc("embed_errors_total", stage="image")
+            raise HTTPException(status_code=400, detail=f"Input {index}: could not load image: {str(e)[:200]}")
+    if not images:
+        return prepared
+
+    texts = [inputs[index].text or "" for index in images]
+    pictures, digests = [picture for picture, _ in loaded], [digest for _, digest in loaded]
+    try:
+        items = await loop.run_in_executor(_image_executor, patchify_images, texts, pictures, digests)
+    except Exception as e:
+        _metrics.inc("embed_errors_total", stage="image")
+        raise HTTPException(status_code=400, detail=f"Could not preprocess images: {str(e)[:200]}")
+    for index, item in zip(images, items):
+        prepared[index] = item
+    return prepared
+
+def json_response(body) -> Response:
+    """Serialize a JSON body (timed as embed_serialize_seconds); call via asyncio.to_thread"""
+    with _metrics.timer("embed_serialize_seconds"):
+        return Response(content=json.dumps(body), media_type="application/json")
 
 @app.get("/health")
 async def health():
-    """Health check endpoint"""
-    return {"status": "ok", "model": "Qwen3-VL-Embedding-8B", "device": _device}
+    """Health check endpoint: always answers (liveness); "ready" says whether requests will be served"""
+    state = readiness()
+    if _pool is not None:
+        info = _pool.info
+    else:
+        info = model_info() if state in ("warming", "ready") else {}
+    return {
+        "status": "ok",
+        "ready": state == "ready",
+        "state": state,
+        # In pool mode: until the first worker was ready
+        "startup_seconds": _pool.ready_seconds if _pool is not None else _ready_seconds,
+        "load_error": _load_error,
+        "model": MODEL_NAME,
+        "device": info.get("device"),
+        "precision": info.get("precision"),
+        "parity": info.get("parity"),
+        "backend": info.get("backend"),
+        "backend_parity": info.get("backend_parity"),
+        "projection": info.get("projection"),
+        "workers": WORKERS or 1,
+        "worker_stats": _pool.stats() if _pool is not None else None,
+        "batching": _batcher.stats(),
+        "batch_limit": _batch_limit.stats() if _pool is None else None,
+        "cache": _cache.stats(),
+        "query_cache": _query_cache.stats(),
+        "indexes": {name: index.stats() for name, index in _indexes.items()}
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text exposition of per-stage latency, batch shape, errors and peak RSS"""
+    return PlainTextResponse(_metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once the model is loaded and warmed up, 503 before"""
+    state = readiness()
+    return JSONResponse({"ready": state == "ready", "state": state}, status_code=200 if state == "ready" else 503)
 
 @app.post("/embeddings", response_model=EmbeddingResponse)
-def create_embeddings(request: EmbeddingRequest):
-    """Generate embeddings for a batch of texts"""
-    if not request.texts:
+async def create_embeddings(request: EmbeddingRequest, http_request: Request):
+    """Generate embeddings for a batch of texts or multimodal inputs, as JSON or a binary body"""
+    _metrics.inc("embed_requests_total", endpoint="/embeddings")
+    require_ready()
+    media_type, dtype = negotiate_encoding(http_request.headers.get("accept", ""))
+
+    if request.texts and request.inputs:
+        raise HTTPException(status_code=400, detail="Send either texts or inputs, not both")
+    if not request.texts and not request.inputs:
         raise HTTPException(status_code=400, detail="No texts provided")
 
+    if request.quantization and media_type == "application/x-npy":
+        raise HTTPException(status_code=406, detail="Quantized output is available as JSON or application/octet-stream")
+
     start = time.time()
 
-    embeddings = generate_embeddings_sync(
-        request.texts,
-        request.normalize,
-        request.output_dim
+    texts = request.texts or await prepare_inputs(request.inputs)
+    lane = request_lane(http_request, request.priority, len(texts))
+    embeddings, stats, errors = await embed_request(texts, request.normalize, request.output_dim, lane, request.mode)
+    if errors and media_type != "application/json":
+        raise embedding_failed(errors)
+
+    # Quantizing and serializing large batches takes a while; keep it off the event loop
+    return await asyncio.to_thread(
+        render_embeddings, request, embeddings, stats, errors, media_type, dtype, (time.time() - start) * 1000
     )
 
-    processing_time = (time.time() - start) * 1000
+def render_embeddings(request: EmbeddingRequest, embeddings: np.ndarray, stats: np.ndarray, errors: Dict[int, str],
+                      media_type: str, dtype: str, processing_time: float) -> Response:
+    """Quantize (if asked) and encode an /embeddings result as JSON or a binary body"""
+    dims = embeddings.shape[1]
+    scales = None
+    if request.quantization:
+        embeddings, scales = quantize_embeddings(embeddings, request.quantization)
+        dtype = request.quantization
 
-    return EmbeddingResponse(
-        embeddings=embeddings,
-        dimensions=len(embeddings[0]) if embeddings else 0,
-        processing_time_ms=processing_time
-    )
+    with _metrics.timer("embed_serialize_seconds"):
+        if media_type != "application/json":
+            return Response(
+                content=encode_embeddings(embeddings, media_type, dtype, scales, dims),
+                media_type=media_type,
+                headers={
+                    "X-Processing-Time-Ms": f"{processing_time:.3f}",
+                    "X-Windowing": json.dumps(window_summary(stats))
+                }
+            )
+
+        vectors = embeddings.tolist()
+        scales = scales.tolist() if scales is not None else None
+        for i in errors:
+            vectors[i] = None
+            if scales is not None:
+                scales[i] = None
+
+        # Serialized here rather than by FastAPI so the time shows up in embed_serialize_seconds
+        response = EmbeddingResponse(
+            embeddings=vectors,
+            dimensions=dims,
+            processing_time_ms=processing_time,
+            quantization=request.quantization,
+            scales=scales,
+            windowing=window_summary(stats),
+            errors=[EmbeddingError(index=i, error=message) for i, message in sorted(errors.items())] or None
+        )
+        return Response(content=response.model_dump_json(), media_type="application/json")
 
 @app.post("/embedding")
-async def create_single_embedding(text: str, normalize: bool = True, output_dim: int = 4096):
-    """Generate embedding for a single text (convenience endpoint)"""
-    result = await create_embeddings(EmbeddingRequest(
-        texts=[text],
-        normalize=normalize,
-        output_dim=output_dim
-    ))
+async def create_single_embedding(http_request: Request, body: Optional[LlamaEmbeddingRequest] = None,
+                                  text: Optional[str] = None, normalize: bool = True, output_dim: int = 4096):
+    """llama-server compatible embedding endpoint"""
+    _metrics.inc("embed_requests_total", endpoint="/embedding")
+    require_ready()
+    start = time.time()
+
+    if body is None:
+        if text is None:
+            raise HTTPException(status_code=400, detail="Provide a JSON body with \"content\" or a text query parameter")
+        embeddings, stats, errors = await embed_request([text], normalize, output_dim, request_lane(http_request, None, 1))
+        if errors:
+            raise embedding_failed(errors)
+        return {
+            "embedding": embeddings[0].tolist(),
+            "dimensions": embeddings.shape[1],
+            "windowing": window_summary(stats),
+            "processing_time_ms": (time.time() - start) * 1000
+        }
+
+    texts = [body.content] if isinstance(body.content, str) else body.content
+    if not texts:
+        raise HTTPException(status_code=400, detail="No content provided")
+
+    lane = request_lane(http_request, body.priority, len(texts))
+    embeddings, _, errors = await embed_request(texts, body.normalize, body.output_dim, lane, body.mode)
+    if errors:
+        raise embedding_failed(errors)
+    return await asyncio.to_thread(
+        lambda: json_response([{"index": i, "embedding": vector.tolist()} for i, vector in enumerate(embeddings)])
+    )
+
+@app.post("/v1/embeddings")
+async def create_openai_embeddings(request: OpenAIEmbeddingRequest, http_request: Request):
+    """OpenAI compatible embeddings endpoint"""
+    _metrics.inc("embed_requests_total", endpoint="/v1/embeddings")
+    require_ready()
+
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    if not texts:
+        raise HTTPException(status_code=400, detail="No input provided")
+
+    lane = request_lane(http_request, None, len(texts))
+    embeddings, stats, errors = await embed_request(texts, True, request.dimensions or 4096, lane)
+    if errors:
+        raise embedding_failed(errors)
+    tokens = int(stats[:, 0].sum())
+
+    def render() -> Response:
+        if request.encoding_format == "base64":
+            vectors = [base64.b64encode(vector.astype("<f4").tobytes()).decode() for vector in embeddings]
+        else:
+            vectors = [vector.tolist() for vector in embeddings]
+        return json_response({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)],
+            "model": request.model or MODEL_NAME,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    return await asyncio.to_thread(render)
+
+class DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse that leaves receive() to the body reader instead of polling it for disconnects"""
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+async def read_ndjson(request: Request):
+    """Yield non-empty lines of the request body as they arrive"""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+def parse_stream_line(line: bytes) -> dict:
+    """A stream line is a JSON string, or an object with "text" and an optional id"""
+    item = json.loads(line)
+    if isinstance(item, str):
+        return {"text": item}
+    if isinstance(item, dict) and isinstance(item.get("text"), str):
+        return item
+    raise ValueError("expected a JSON string or an object with a \"text\" field")
+
+@app.post("/embeddings/stream")
+async def stream_embeddings(request: Request, normalize: bool = True, output_dim: int = 4096,
+                            mode: Optional[Literal["query", "document"]] = None):
+    """Embed a newline-delimited stream of texts, one output line per text as its chunk finishes"""
+    _metrics.inc("embed_requests_total", endpoint="/embeddings/stream")
+    require_ready()
+    try:
+        _batcher.check_capacity()
+    except Overloaded as e:
+        raise too_many_requests(e)
+
+    def submit(items: List[dict]):
+        texts = [item["text"] for item in items]
+        future = asyncio.wrap_future(embed_texts(texts, normalize, output_dim, bounded=False, mode=mode or ""))
+        future.items = items
+        return future
+
+    def emit(future) -> str:
+        lines = []
+        vectors, stats, errors = future.result()
+        for k, (item, vector, (_, windows, truncated)) in enumerate(zip(future.items, vectors, stats)):
+            if k in errors:
+                line = {"index": item["index"], "error": errors[k]}
+            else:
+                line = {"index": item["index"], "embedding": vector.tolist()}
+            if "id" in item:
+                line["id"] = item["id"]
+            if k not in errors and (windows > 1 or truncated):
+                line["windows"] = int(windows)
+                line["truncated_tokens"] = int(truncated)
+            lines.append(json.dumps(line))
+        return "\n".join(lines) + "\n"
+
+    async def generate():
+        pending = set()
+        chunk = []
+        index = 0
+
+        async for line in read_ndjson(request):
+            try:
+                item = parse_stream_line(line)
+            except ValueError as e:
+                yield json.dumps({"index": index, "error": str(e)[:200]}) + "\n"
+                index += 1
+                continue
+
+            item["index"] = index
+            index += 1
+            chunk.append(item)
+            if len(chunk) < STREAM_CHUNK_SIZE:
+                continue
+
+            pending.add(submit(chunk))
+            chunk = []
+            while len(pending) >= STREAM_MAX_INFLIGHT:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield emit(future)
+
+        if chunk:
+            pending.add(submit(chunk))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield emit(future)
+
+    return DuplexStreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.post("/search")
+async def search(request: SearchRequest, http_request: Request):
+    """Embed a query and return the k nearest ids in a vector index, in one call"""
+    _metrics.inc("embed_requests_total", endpoint="/search")
+    index = _indexes.get(request.index)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Unknown index {request.index!r}")
+    if request.k < 1:
+        raise HTTPException(status_code=400, detail="k must be at least 1")
+    require_ready()
+    start = time.time()
+
+    embeddings, _, errors = await embed_request(
+        [request.query], True, index.output_dim, request_lane(http_request, None, 1), request.mode
+    )
+    if errors:
+        raise embedding_failed(errors)
+    embedded = time.time()
+
+    def scan():
+        with _metrics.timer("embed_search_seconds"):
+            return index.search(embeddings[0], request.k, request.nprobe or INDEX_NPROBE)
+
+    try:
+        results, exact = await asyncio.to_thread(scan)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if request.min_similarity is not None:
+        results = [(record_id, similarity) for record_id, similarity in results if similarity > request.min_similarity]
+
+    return {
+        "index": request.index,
+        "results": [{"id": record_id, "similarity": similarity} for record_id, similarity in results],
+        "exact": exact,
+        "embed_ms": (embedded - start) * 1000,
+        "search_ms": (time.time() - embedded) * 1000,
+        "processing_time_ms": (time.time() - start) * 1000
+    }
+
+def open_index(name: str, settings: dict) -> VectorIndex:
+    """Loaded index by name, or a new one under EMBED_INDEX_DIR"""
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            if not INDEX_DIR:
+                raise HTTPException(status_code=400, detail="Set EMBED_INDEX_DIR to create indexes")
+            if name.startswith(".") or not name.replace("-", "").replace("_", "").replace(".", "").isalnum():
+                raise HTTPException(status_code=400, detail=f"Invalid index name {name!r}")
+            index = _indexes[name] = VectorIndex(os.path.join(INDEX_DIR, name), settings)
+    return index
+
+@app.post("/index/{name}/add")
+async def add_to_index(name: str, request: IndexAddRequest):
+    """Add rows (texts to embed, or vectors) to a vector index, creating it if needed"""
+    _metrics.inc("embed_requests_total", endpoint="/index/add")
+    if (request.texts is None) == (request.embeddings is None):
+        raise HTTPException(status_code=400, detail="Send either texts or embeddings")
+    values = request.texts if request.texts is not None else request.embeddings
+    if not request.ids:
+        raise HTTPException(status_code=400, detail="No ids provided")
+    if len(values) != len(request.ids):
+        raise HTTPException(status_code=400, detail=f"Got {len(request.ids)} ids for {len(values)} rows")
+
+    output_dim = request.output_dim if request.texts is not None else len(values[0])
+    index = open_index(name, {
+        "model": MODEL_NAME, "projection": PROJECTION_PATH, "hidden_layer": HIDDEN_LAYER,
+        "output_dim": output_dim, "variant": embedding_variant(request.mode or "")
+    })
+
+    ids, errors = request.ids, {}
+    if request.texts is not None:
+        require_ready()
+        embeddings, _, errors = await embed_request(request.texts, True, index.output_dim, "bulk", request.mode)
+        keep = [i for i in range(len(ids)) if i not in errors]
+        ids, vectors = [ids[i] for i in keep], embeddings[keep]
+    elif len({len(vector) for vector in values}) > 1:
+        raise HTTPException(status_code=400, detail="Embeddings must all have the same length")
+    else:
+        vectors = np.array(values, dtype=np.float32)
+
+    try:
+        rows = await asyncio.to_thread(index.add, ids, vectors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {
-        "embedding": result.embeddings[0],
-        "dimensions": result.dimensions,
-        "processing_time_ms": result.processing_time_ms
+        "index": name,
+        "added": len(ids),
+        "rows": rows,
+        "errors": [{"index": i, "error": message} for i, message in sorted(errors.items())] or None
+    }
+
+@app.get("/index")
+async def list_indexes():
+    """Loaded vector indexes and their sizes"""
+    return {name: index.stats() for name, index in _indexes.items()}
+
+def read_records(path: str):
+    """Yield (id, text) from a JSONL or Parquet file"""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(columns=["id", "text"]):
+            yield from zip(batch.column("id").to_pylist(), batch.column("text").to_pylist())
+        return
+
+    with open(path, encoding="utf-8") as f:
+        index = 0
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield item.get("id", index), item.get("text") or ""
+            index += 1
+
+def count_records(path: str) -> int:
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+def write_manifest(path: str, manifest: dict):
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def embed_file(input_path: str, out_dir: str, normalize: bool, output_dim: int, mode: str = ""):
+    """Embed every record of a JSONL/Parquet file into .npy shards, without the HTTP server"""
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    settings = {
+        "input": os.path.abspath(input_path),
+        "model": MODEL_NAME,
+        "projection": PROJECTION_PATH,
+        "hidden_layer": HIDDEN_LAYER,
+        "normalize": normalize,
+        "output_dim": output_dim,
+        "variant": embedding_variant(mode),
+        "shard_rows": OFFLINE_SHARD_ROWS,
     }
 
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        # Runs from before the layer was recorded embedded from the final layer
+        manifest["settings"].setdefault("hidden_layer", -1)
+        if manifest["settings"] != settings:
+            raise SystemExit(f"{manifest_path} was written with different settings; use a new output directory")
+        manifest.setdefault("errors", [])
+        print(f"Resuming at row {manifest['rows_done']} of {manifest['total']}")
+    else:
+        manifest = {
+            "settings": settings, "total": count_records(input_path), "dim": None, "rows_done": 0, "shards": [], "errors": []
+        }
+        write_manifest(manifest_path, manifest)
+
+    total = manifest["total"]
+    if manifest["rows_done"] >= total:
+        print(f"{out_dir} is already complete ({total} rows)")
+        return
+
+    if _pool is not None:
+        _pool.start()
+    else:
+        load_model()
+
+    def shard_path(shard: int, suffix: str) -> str:
+        return os.path.join(out_dir, f"shard-{shard:05d}{suffix}")
+
+    shard_ids = {}
+    open_shard = {}
+
+    def write_chunk(start_row: int, vectors: np.ndarray, errors: Dict[int, str]):
+        """Copy a finished chunk into its shard; seal the shard with its ids once it is full"""
+        shard, offset = divmod(start_row, OFFLINE_SHARD_ROWS)
+        for k, message in sorted(errors.items()):
+            manifest["errors"].append({"row": start_row + k, "id": shard_ids[shard][offset + k], "error": message})
+        rows = min(OFFLINE_SHARD_ROWS, total - shard * OFFLINE_SHARD_ROWS)
+        if manifest["dim"] is None:
+            manifest["dim"] = vectors.shape[1]
+        if open_shard.get("index") != shard:
+            path = shard_path(shard, ".npy")
+            open_shard["index"] = shard
+            open_shard["vectors"] = np.lib.format.open_memmap(
+                path, mode="r+" if os.path.exists(path) else "w+", dtype=np.float32, shape=(rows, manifest["dim"])
+            )
+
+        open_shard["vectors"][offset:offset + len(vectors)] = vectors
+        open_shard["vectors"].flush()
+        manifest["rows_done"] = start_row + len(vectors)
+
+        if offset + len(vectors) == rows:
+            with open(shard_path(shard, ".ids"), "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(record_id) + "\n" for record_id in shard_ids.pop(shard))
+            manifest["shards"].append({"vectors": f"shard-{shard:05d}.npy", "ids": f"shard-{shard:05d}.ids", "rows": rows})
+            open_shard.clear()
+        write_manifest(manifest_path, manifest)
+
+    start = last_report = time.time()
+    rows_done = manifest["rows_done"]
+    first_open_row = rows_done - rows_done % OFFLINE_SHARD_ROWS
+    in_flight = []
+    max_in_flight = WORKERS or INFERENCE_THREADS
+    chunk_start, chunk_texts = rows_done, []
+
+    def drain(limit: int):
+        nonlocal last_report
+        while len(in_flight) > limit:
+            start_row, future = in_flight.pop(0)
+            vectors, _, errors = future.result()
+            write_chunk(start_row, vectors, errors)
+            if time.time() - last_report >= 10:
+                last_report = time.time()
+                done = manifest["rows_done"] - rows_done
+                print(f"{manifest['rows_done']}/{total} rows ({done / (last_report - start):.1f}/s)", flush=True)
+
+    for row, (record_id, text) in enumerate(read_records(input_path)):
+        # Ids are collected for the whole open shard, including rows a resumed run skips
+        if row >= first_open_row:
+            shard_ids.setdefault(row // OFFLINE_SHARD_ROWS, []).append(record_id)
+        if row < rows_done:
+            continue
+
+        chunk_texts.append(text if isinstance(text, str) else "")
+        # Chunks never straddle a shard boundary
+        if len(chunk_texts) == OFFLINE_CHUNK_SIZE or (row + 1) % OFFLINE_SHARD_ROWS == 0:
+            in_flight.append((chunk_start, run_pass(chunk_texts, normalize, output_dim, mode=mode)))
+            chunk_start, chunk_texts = row + 1, []
+            drain(max_in_flight - 1)
+
+    if chunk_texts:
+        in_flight.append((chunk_start, run_pass(chunk_texts, normalize, output_dim, mode=mode)))
+    drain(0)
+
+    print(f"Embedded {total - rows_done} rows into {len(manifest['shards'])} shards in {time.time() - start:.1f}s")
+    if manifest["errors"]:
+        print(f"{len(manifest['errors'])} rows could not be embedded; see \"errors\" in {manifest_path}")
+
+def copy_escape(value: str) -> str:
+    """Escape a value for PostgreSQL COPY text format"""
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def read_shard_rows(out_dir: str):
+    """Yield (id, vector) for the finished shards of an --embed-file run, skipping failed rows"""
+    with open(os.path.join(out_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    failed = {error["row"] for error in manifest.get("errors", [])}
+
+    for n, shard in enumerate(manifest["shards"]):
+        vectors = np.load(os.path.join(out_dir, shard["vectors"]), mmap_mode="r")
+        with open(os.path.join(out_dir, shard["ids"]), encoding="utf-8") as f:
+            for row, (record_id, vector) in enumerate(zip(f, vectors), start=n * manifest["settings"]["shard_rows"]):
+                if row not in failed and vector.any():
+                    yield json.loads(record_id), vector
+
+def write_copy_rows(out_dir: str, output=sys.stdout):
+    """Stream finished shards as COPY text rows of (id, vector), skipping failed rows"""
+    for record_id, vector in read_shard_rows(out_dir):
+        output.write(f"{copy_escape(str(record_id))}\t[{','.join(map(str, vector.tolist()))}]\n")
+
+COPY_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f", "v": "\v"}
+
+def copy_unescape(value: str) -> str:
+    """Undo PostgreSQL COPY text format escapes"""
+    if "\\" not in value:
+        return value
+    out, i = [], 0
+    while i < len(value):
+        if value[i] == "\\" and i + 1 < len(value):
+            out.append(COPY_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+        else:
+            out.append(value[i])
+            i += 1
+    return "".join(out)
+
+def read_copy_rows(path: str):
+    """Yield (id, vector) from COPY text rows of (id, vector) ("-" = stdin)"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line or line == "\\.":
+                continue
+            record_id, _, vector = line.rpartition("\t")
+            if vector == "\\N":
+                continue
+            record_id = copy_unescape(record_id)
+            if record_id.lstrip("-").isdigit():
+                record_id = int(record_id)
+            yield record_id, np.fromstring(vector.strip("[]"), dtype=np.float32, sep=",")
+
+def build_index(index_path: str, source: str, mode: str = ""):
+    """Build or extend a vector index from --embed-file output or a pgvector COPY dump"""
+    if os.path.isdir(source):
+        with open(os.path.join(source, "manifest.json")) as f:
+            manifest = json.load(f)
+        settings = {name: manifest["settings"][name] for name in ("model", "projection", "output_dim", "variant")}
+        settings["hidden_layer"] = manifest["settings"].get("hidden_layer", -1)
+        rows = read_shard_rows(source)
+    else:
+        settings = {
+            "model": MODEL_NAME, "projection": PROJECTION_PATH, "hidden_layer": HIDDEN_LAYER,
+            "output_dim": None, "variant": embedding_variant(mode)
+        }
+        rows = read_copy_rows(source)
+
+    start = time.time()
+    index = None
+    added = 0
+    ids, vectors = [], []
+
+    def flush():
+        nonlocal index, added
+        if index is None:
+            settings["output_dim"] = settings["output_dim"] or len(vectors[0])
+            index = VectorIndex(index_path, settings)
+            if index.meta["settings"] != settings:
+                raise SystemExit(f"{index_path} was built with different settings; use a new index directory")
+        index.add(ids, np.stack(vectors))
+        added += len(ids)
+        ids.clear()
+        vectors.clear()
+
+    skipped = 0
+    for record_id, vector in rows:
+        # Zero vectors are failed embeddings, whichever source they come from
+        if not vector.any():
+            skipped += 1
+            continue
+        ids.append(record_id)
+        vectors.append(vector)
+        if len(ids) == VectorIndex.ADD_CHUNK:
+            flush()
+    if ids:
+        flush()
+
+    if skipped:
+        print(f"Skipped {skipped} all-zero vectors in {source}")
+    if index is None:
+        print(f"No rows in {source}")
+        return
+    stats = index.stats()
+    print(f"Added {added} rows to {index_path} in {time.time() - start:.1f}s "
+          f"({stats['live_rows']} live rows, {stats['lists']} lists)")
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8081, log_level="info")
+    parser = argparse.ArgumentParser(description="Qwen3-VL embedding server")
+    parser.add_argument("--write-parity-reference", metavar="PATH",
+                        help="embed the reference texts in fp32, save them to PATH and exit")
+    parser.add_argument("--embed-file", metavar="PATH",
+                        help="embed a JSONL/Parquet file of {id, text} into .npy shards in --out and exit")
+    parser.add_argument("--out", metavar="DIR", help="output directory for --embed-file (rerun to resume)")
+    parser.add_argument("--output-dim", type=int, default=4096)
+    parser.add_argument("--no-normalize", action="store_true")
+    parser.add_argument("--mode", choices=sorted(MODE_TEMPLATES),
+                        help="instruction template for --embed-file, or the one a --build-index COPY dump was embedded with")
+    parser.add_argument("--copy-rows", metavar="DIR",
+                        help="write the shards in DIR to stdout as COPY rows (id, vector) for pgvector and exit")
+    parser.add_argument("--build-index", metavar="DIR",
+                        help="add the vectors in --index-source to the vector index in DIR (e.g. $EMBED_INDEX_DIR/slack) and exit")
+    parser.add_argument("--index-source", metavar="PATH",
+                        help="--embed-file output directory, or a COPY (id, vector) dump from pgvector ('-' = stdin)")
+    args = parser.parse_args()
+
+    if args.write_parity_reference:
+        CPU_PRECISION = "fp32"
+        load_model()
+        write_parity_reference(args.write_parity_reference)
+    elif args.embed_file:
+        if not args.out:
+            parser.error("--embed-file needs --out")
+        embed_file(args.embed_file, args.out, not args.no_normalize, args.output_dim, args.mode or "")
+    elif args.copy_rows:
+        write_copy_rows(args.copy_rows)
+    elif args.build_index:
+        if not args.index_source:
+            parser.error("--build-index needs --index-source")
+        build_index(args.build_index, args.index_source, args.mode or "")
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8081, log_level="info")
@@ -72,7 +72,7 @@ async function generateEmbedding(text: string): Promise<number[]> {
   const response = await fetch(`http://localhost:${CONFIG.embeddingPort}/embedding`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ content: text }),
+    body: JSON.stringify({ content: text, priority: "bulk" }),
   });
 
   if (!response.ok) {
@@ -91,7 +91,7 @@ async function indexSlack() {
       }
 
       for (const chunk of chunks) {
-        const embedding = await generateEmbedding(chunk.text);
+        const embedding = await generateEmbedding(chunk.text, "bulk");
 
         // Format embedding as PostgreSQL vector literal
         const vectorLiteral = `[${embedding.join(",")}]`;
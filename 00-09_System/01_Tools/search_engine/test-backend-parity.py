@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Backend parity test - compile and onnx text encoders against eager on the bench stand-in
+Texts are drawn from the stand-in's vocabulary, so every position is a real token id;
+exits non-zero when a backend fails to build or its cosine to eager drops below the floor
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+BENCH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qwen3vl-embed-bench.py")
+
+def load_bench():
+    spec = importlib.util.spec_from_file_location("qwen3vl_embed_bench", BENCH_PATH)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check compile/onnx backends against eager on the bench stand-in")
+    parser.add_argument("--backends", default="compile,onnx")
+    parser.add_argument("--min-cosine", type=float, default=0.999)
+    parser.add_argument("--texts", type=int, default=24, help="half short, half medium")
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    bench = load_bench()
+    # A fresh checkpoint dir, so every run exports and compiles instead of reusing artifacts
+    server = bench.load_server({
+        "EMBED_CACHE_SIZE": "0",
+        "EMBED_CACHE_DIR": "",
+        "EMBED_WARMUP_LENGTHS": "",
+        "EMBED_WORKERS": "0",
+        "EMBED_CHECKPOINT_DIR": tempfile.mkdtemp(prefix="embed-parity-"),
+    })
+
+    model, processor = bench.build_stand_in(args.hidden_size, args.layers, args.heads, args.seed)
+    server.truncate_layers(model, server.HIDDEN_LAYER)
+    server._model, server._processor, server._device = model, processor, "cpu"
+    server._batch_limit.set_budget()
+
+    rng = random.Random(args.seed)
+    texts = bench.make_texts(rng, "short", args.texts // 2) + bench.make_texts(rng, "medium", args.texts - args.texts // 2)
+
+    failed = False
+    for backend in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        server.BACKEND = backend
+        server.setup_backend()
+        if server._backend != backend:
+            print(f"{backend:<8} FAIL: fell back to eager")
+            failed = True
+            continue
+
+        cosines = server.backend_cosines(texts)
+        ok = cosines.min() >= args.min_cosine
+        failed = failed or not ok
+        print(f"{backend:<8} {'ok' if ok else 'FAIL'}: {len(cosines)} texts, "
+              f"mean cosine {cosines.mean():.6f}, min {cosines.min():.6f} (floor {args.min_cosine})")
+        server._backend, server._text_encoder = "eager", None
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Prefix cache test - query-mode vectors from the KV-cached instruction prefix against full-prompt encoding
+Uses the bench stand-in with a byte-level BPE tokenizer, where a space before the text merges into its
+first token; exits non-zero when any text's cosine to the full prompt drops below the floor
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+BENCH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "qwen3vl-embed-bench.py")
+
+WORDS = ["how", "do", "I", "reset", "my", "password", "invoice", "meeting", "notes", "from", "last", "week",
+         "budget", "review", "slack", "thread", "about", "the", "launch", "email", "contract", "renewal"]
+
+def load_bench():
+    spec = importlib.util.spec_from_file_location("qwen3vl_embed_bench", BENCH_PATH)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench
+
+def byte_level_tokenizer(corpus, vocab_size: int):
+    """A byte-level BPE like Qwen's, trained on the corpus"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size, special_tokens=["[PAD]", "<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", eos_token="<|endoftext|>")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check prefix-cached query vectors against full-prompt encoding")
+    parser.add_argument("--min-cosine", type=float, default=0.9999)
+    parser.add_argument("--texts", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    bench = load_bench()
+    server = bench.load_server({
+        "EMBED_CACHE_SIZE": "0",
+        "EMBED_QUERY_CACHE_SIZE": "0",
+        "EMBED_CACHE_DIR": "",
+        "EMBED_WARMUP_LENGTHS": "",
+        "EMBED_WORKERS": "0",
+        "EMBED_BACKEND": "eager",
+        "EMBED_CHECKPOINT_DIR": tempfile.mkdtemp(prefix="embed-prefix-"),
+    })
+
+    rng = random.Random(args.seed)
+    texts = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))) for _ in range(args.texts)]
+    # Seams that merge differently: leading punctuation, a leading space and a newline
+    texts += [": colon first", "?! marks first", " leading space", "\nnewline first", "Query: repeated label"]
+    # The default template, and one without the space, where leading punctuation merges into the prefix's colon
+    # and those texts are encoded in full
+    templates = [server.QUERY_TEMPLATE, server.QUERY_TEMPLATE.replace(": {text}", ":{text}")]
+    corpus = [template.replace("{text}", text) for template in templates for text in texts]
+
+    model, processor = bench.build_stand_in(64, 2, 4, args.seed)
+    processor.tokenizer = byte_level_tokenizer(corpus + WORDS, 1000)
+    server.truncate_layers(model, server.HIDDEN_LAYER)
+    server._model, server._processor, server._device = model, processor, "cpu"
+    server._batch_limit.set_budget()
+
+    failed = False
+    for template in templates:
+        server.MODE_TEMPLATES["query"] = template
+        prefix, suffix = server.template_parts("query")
+        for pooling in ("last", "mean"):
+            server.POOLING = pooling
+            server._metrics.counters.clear()
+            cached, _, errors = server.generate_embeddings_sync(texts, True, 0, mode="query")
+            fallbacks = int(server._metrics.counters.get(("embed_prefix_fallbacks_total", ()), 0))
+            full = reference_vectors(server, texts, prefix, suffix)
+            cosines = (cached * full).sum(axis=1)
+            ok = not errors and cosines.min() >= args.min_cosine
+            failed = failed or not ok
+            print(f"{pooling:<5} {repr(prefix[-7:]):<11} {'ok' if ok else 'FAIL'}: {len(texts)} texts, "
+                  f"{fallbacks} encoded in full, min cosine {cosines.min():.6f} (floor {args.min_cosine}){f', errors {errors}' if errors else ''}")
+
+    return 1 if failed else 0
+
+def reference_vectors(server, texts, prefix, suffix):
+    """Each text's prompt encoded in one pass, pooled from its first token that differs from the prefix's"""
+    import numpy as np
+    import torch
+
+    tokenizer = server._processor.tokenizer
+    prefix_ids = tokenizer(prefix.rstrip(), add_special_tokens=False)["input_ids"]
+    vectors = []
+    with torch.no_grad():
+        for text in texts:
+            ids = tokenizer(prefix + text + suffix)["input_ids"]
+            prefix_length = next((k for k, (a, b) in enumerate(zip(ids, prefix_ids)) if a != b), len(prefix_ids))
+            if server.POOLING == "last":
+                ids = ids + [tokenizer.eos_token_id]
+            hidden = server.encoder()(input_ids=torch.tensor([ids]), use_cache=False).last_hidden_state
+            mask = torch.ones(1, len(ids), dtype=torch.long)
+            mask[:, :prefix_length] = 0
+            pooled = server.pool_hidden(hidden, mask)
+            vectors.append(server.reduce_dimensions(pooled, True, 0)[0].numpy())
+    return np.stack(vectors)
+
+if __name__ == "__main__":
+    sys.exit(main())
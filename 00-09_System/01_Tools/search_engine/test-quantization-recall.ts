@@ -0,0 +1,128 @@
+// Measure recall of quantized (int8 / binary) embeddings against float output
+const EMBED_URL = process.env.EMBED_SERVER_URL || "http://localhost:8081";
+const K = 5;
+const RESCORE_FACTOR = 4;
+
+// Minimum mean recall@K per mode; below any of them the test fails
+const RECALL_FLOOR = { int8: 0.95, binary: 0.6, rescored: 0.9 };
+
+interface EmbeddingResponse {
+  embeddings: number[][]; // floats, or integers (int8 values / packed sign bytes) when quantized
+  dimensions: number;
+  processing_time_ms: number;
+  quantization?: string;
+  scales?: number[];
+}
+
+async function generateEmbeddings(texts: string[], quantization?: "int8" | "binary"): Promise<EmbeddingResponse> {
+  const response = await fetch(`${EMBED_URL}/embeddings`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ texts, normalize: true, output_dim: 4096, quantization })
+  });
+
+  if (!response.ok) {
+    throw new Error(`Failed: ${response.status} ${await response.text()}`);
+  }
+
+  return response.json();
+}
+
+// Fixed corpus: a few topics so neighbours are meaningful
+const corpus = [
+  "PostgreSQL uses MVCC to handle concurrent transactions.",
+  "pgvector adds an approximate nearest neighbour index to Postgres.",
+  "HNSW graphs trade memory for fast vector search.",
+  "IVFFlat partitions vectors into lists before searching.",
+  "Vacuum reclaims storage occupied by dead tuples.",
+  "The quarterly budget review is scheduled for Thursday.",
+  "Please send the signed contract before the end of the week.",
+  "The invoice for October is attached to this email.",
+  "Our vendor raised prices by eight percent this year.",
+  "Finance approved the headcount request for next quarter.",
+  "The hiking trail follows the ridge above the lake.",
+  "Pack a rain jacket because mountain weather changes fast.",
+  "The campsite has fresh water but no electricity.",
+  "We reached the summit just after sunrise.",
+  "The trailhead parking lot fills up early on weekends.",
+  "Bun runs TypeScript files without a separate build step.",
+  "The watcher reindexes files whenever they change on disk.",
+  "Slack messages are chunked by thread before embedding.",
+  "Transcripts are split by speaker turns for search.",
+  "The API server listens on port 3000.",
+  "Sourdough needs a mature starter and a long proof.",
+  "Roast the vegetables at high heat until they caramelize.",
+  "Season the soup with salt at the end of cooking.",
+  "Fresh pasta cooks in only a couple of minutes.",
+  "Let the steak rest before slicing it.",
+];
+
+const queries = [
+  "How does Postgres index embeddings?",
+  "When is the budget meeting?",
+  "What should I bring on a mountain hike?",
+  "How are chat messages prepared for search?",
+  "How long should bread dough rise?",
+];
+
+const dot = (a: number[], b: number[]) => a.reduce((sum, x, i) => sum + x * b[i], 0);
+
+function unpackBits(packed: number[], dimensions: number): number[] {
+  const signs = new Array(dimensions);
+  for (let i = 0; i < dimensions; i++) {
+    signs[i] = (packed[i >> 3] >> (7 - (i & 7))) & 1 ? 1 : -1;
+  }
+  return signs;
+}
+
+function topK(scores: number[], k: number): number[] {
+  return scores.map((score, i) => [score, i]).sort((a, b) => b[0] - a[0]).slice(0, k).map(([, i]) => i);
+}
+
+function recall(expected: number[], actual: number[]): number {
+  return actual.filter(i => expected.includes(i)).length / expected.length;
+}
+
+console.log("Measuring quantized embedding recall...\n");
+
+const floatDocs = (await generateEmbeddings(corpus)).embeddings;
+const floatQueries = (await generateEmbeddings(queries)).embeddings;
+const int8 = await generateEmbeddings(corpus, "int8");
+const binary = await generateEmbeddings(corpus, "binary");
+const dimensions = binary.dimensions;
+
+// Dequantize: x ~= scale * q (int8), x ~= scale * sign (binary)
+const int8Docs = int8.embeddings.map((q, d) => q.map(x => x * int8.scales![d]));
+const binaryDocs = binary.embeddings.map((packed, d) => unpackBits(packed, dimensions).map(x => x * binary.scales![d]));
+
+const totals = { int8: 0, binary: 0, rescored: 0 };
+
+for (const query of floatQueries) {
+  const expected = topK(floatDocs.map(doc => dot(query, doc)), K);
+
+  totals.int8 += recall(expected, topK(int8Docs.map(doc => dot(query, doc)), K));
+
+  const binaryScores = binaryDocs.map(doc => dot(query, doc));
+  totals.binary += recall(expected, topK(binaryScores, K));
+
+  // Binary candidates, rescored against the float document vectors
+  const candidates = topK(binaryScores, K * RESCORE_FACTOR);
+  const rescored = candidates.map(i => [dot(query, floatDocs[i]), i]).sort((a, b) => b[0] - a[0]).slice(0, K).map(([, i]) => i);
+  totals.rescored += recall(expected, rescored);
+}
+
+const bytesFloat = dimensions * 4;
+console.log(`Corpus: ${corpus.length} docs, ${queries.length} queries, ${dimensions} dims, recall@${K}\n`);
+console.log(`float32:          recall 1.000  ${bytesFloat} bytes/vector`);
+console.log(`int8:             recall ${(totals.int8 / queries.length).toFixed(3)}  ${dimensions + 4} bytes/vector`);
+console.log(`binary:           recall ${(totals.binary / queries.length).toFixed(3)}  ${Math.ceil(dimensions / 8) + 4} bytes/vector`);
+console.log(`binary+rescore:   recall ${(totals.rescored / queries.length).toFixed(3)}  (top ${K * RESCORE_FACTOR} rescored with float)`);
+
+const failures = (Object.keys(RECALL_FLOOR) as (keyof typeof RECALL_FLOOR)[])
+  .filter(mode => totals[mode] / queries.length < RECALL_FLOOR[mode])
+  .map(mode => `${mode} recall ${(totals[mode] / queries.length).toFixed(3)} is below the floor of ${RECALL_FLOOR[mode]}`);
+if (failures.length) {
+  console.error(`\nFAIL:\n  ${failures.join("\n  ")}`);
+  process.exit(1);
+}
+console.log("\nPASS: every mode is at or above its recall floor");